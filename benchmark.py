@@ -0,0 +1,266 @@
+# Offline benchmarks for the bill export pipeline
+# Runs on synthetic data only, no m3ter credentials or database needed
+# Usage: python benchmark.py flatten --scales 10000 100000 1000000
+#        python benchmark.py measurements --scales 100000 1000000
+#        python benchmark.py enrich --scales 100000 1000000
+#        python benchmark.py e2e --scales 1000 10000 100000 --latency 0.005
+
+import argparse
+import gc
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import main
+import m3terSDK as m3ter
+from instrumentation import RunReport
+from stubServer import BILL_DATES, StubServer, syntheticBills, syntheticDataset, xrefFixture
+
+def measure(fn, *args):
+    # Wall time of one clean run, then peak traced allocation of a second run
+    gc.collect()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def report(name, scale, elapsed, peak):
+    print(json.dumps({'benchmark': name, 'scale': scale, 'seconds': round(elapsed, 3),
+                      'peakMB': round(peak / 1024 / 1024, 1)}))
+
+
+# flatten - the original line item preparation (two json_normalize passes, unit price by row position, column
+# selection and formatting) against main.prepareLineItems, which is what the export runs: flattenBills, the chunk
+# concat and joinPricingBands
+def twoPassFlatten(bills, billDate):
+    bills_df = pd.json_normalize(bills, record_path='lineItems',
+                                 meta=['id', 'version', 'accountId', 'accountCode',
+                                       'startDate', 'endDate', 'startDateTimeUTC',
+                                       'endDateTimeUTC', 'billDate', 'dueDate',
+                                       'billingFrequency', 'billFrequencyInterval',
+                                       'timezone', 'currency', 'locked', 'createdDate',
+                                       'status', 'billJobId', 'lastCalculatedDate'],
+                                 errors='ignore', record_prefix='lineItems-')
+    bills_df = bills_df.loc[bills_df.billDate == billDate]
+    pricingBand_df = pd.json_normalize(bills, ['lineItems', 'usagePerPricingBand'],
+                                       record_prefix='lineItems-usagePerPricingBand-')
+    bills_df['lineItems-usagePerPricingBand-unitPrice'] = pricingBand_df['lineItems-usagePerPricingBand-unitPrice']
+    bills_df_columns = bills_df[
+        ['id', 'accountId', 'accountCode', 'lineItems-productId', 'lineItems-quantity', 'lineItems-productName',
+         'lastCalculatedDate', 'lineItems-usagePerPricingBand', 'lineItems-description', 'lineItems-meterId',
+         'lineItems-usagePerPricingBand-unitPrice', 'lineItems-planId']]
+    bills_df_columns['lastCalculatedDate'] = pd.to_datetime(bills_df_columns['lastCalculatedDate']).dt.strftime('%d/%m/20%y')
+    return bills_df_columns.round(2)
+
+
+def pipelineFlatten(bills, billDate):
+    return main.prepareLineItems(bills, billDate, RunReport('benchmark'))
+
+
+def benchFlatten(args):
+    for scale in args.scales:
+        bills = syntheticBills(scale)
+        report('flatten/json_normalize', scale, *measure(twoPassFlatten, bills, BILL_DATES[0]))
+        report('flatten/prepareLineItems', scale, *measure(pipelineFlatten, bills, BILL_DATES[0]))
+        del bills
+
+
+# measurements - the original dict-backed MeasurementData and json.dumps against the slotted class and the
+# columnar MeasurementColumns with the fast encoder
+class DictMeasurementData:
+    def __init__(self, meterCode="", accountCode="", timestamp="2022-11-01T00:00:00Z", measure=None, who=None):
+        self.meter = meterCode
+        self.account = accountCode
+        self.ts = timestamp
+        if measure:
+            self.measure = measure
+        if who:
+            self.who = who
+        self.uid = ""
+
+    def todict(self):
+        return self.__dict__
+
+
+def buildDictMeasurements(scale):
+    return [DictMeasurementData('api_calls', f'account-{i % 500}', '2022-11-01T00:00:00Z',
+                                measure={'calls': float(i % 97)}, who={'user': f'user-{i % 50}'}) for i in range(scale)]
+
+
+def buildSlottedMeasurements(scale):
+    return [m3ter.MeasurementData('api_calls', f'account-{i % 500}', '2022-11-01T00:00:00Z',
+                                  measure={'calls': float(i % 97)}, who={'user': f'user-{i % 50}'}) for i in range(scale)]
+
+
+def buildColumnarMeasurements(scale):
+    return m3ter.MeasurementColumns(meter=['api_calls'] * scale, account=[f'account-{i % 500}' for i in range(scale)],
+                                    ts=['2022-11-01T00:00:00Z'] * scale,
+                                    measure={'calls': [float(i % 97) for i in range(scale)]},
+                                    who={'user': [f'user-{i % 50}' for i in range(scale)]})
+
+
+def serialiseDict(measurements, batchSize=1000):
+    for start in range(0, len(measurements), batchSize):
+        json.dumps({'measurements': [m.todict() for m in measurements[start:start + batchSize]], 'id': ''})
+
+
+def serialiseSlotted(measurements, batchSize=1000):
+    for start in range(0, len(measurements), batchSize):
+        m3ter.dumps({'measurements': measurements[start:start + batchSize]})
+
+
+def serialiseColumnar(measurements, batchSize=1000):
+    for payload in measurements.payloads(batchSize):
+        pass
+
+
+def retainedMemory(build, scale):
+    gc.collect()
+    tracemalloc.start()
+    built = build(scale)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, retained
+
+
+def benchMeasurements(args):
+    variants = [('MeasurementData(dict)', buildDictMeasurements, serialiseDict),
+                ('MeasurementData(slots)', buildSlottedMeasurements, serialiseSlotted),
+                ('MeasurementColumns', buildColumnarMeasurements, serialiseColumnar)]
+    for scale in args.scales:
+        for name, build, serialise in variants:
+            built, retained = retainedMemory(build, scale)
+            start = time.perf_counter()
+            serialise(built)
+            elapsed = time.perf_counter() - start
+            print(json.dumps({'benchmark': 'measurements/' + name, 'scale': scale,
+                              'retainedMB': round(retained / 1024 / 1024, 1), 'serialiseSeconds': round(elapsed, 3),
+                              'eventsPerSecond': int(scale / elapsed) if elapsed else None,
+                              'encoder': 'orjson' if m3ter.orjson is not None else 'json'}))
+            del built
+
+
+# enrich - the five chained DataFrame.merge calls against main.Enrichment, at month-end volumes
+def syntheticDimensions(accounts=50000, plans=2000, meters=200, seed=1):
+    rng = np.random.default_rng(seed)
+    account_df = pd.DataFrame({'accountId': [f'account-{i}' for i in range(accounts)],
+                               'accountCode': [f'AC{i}' for i in range(accounts)],
+                               'accountName': [f'Account {i}' for i in range(accounts)],
+                               'subsidiaryId': pd.array(rng.integers(1, 20, accounts), dtype='Int64')})
+    plan_df = pd.DataFrame({'planId': [f'plan-{i}' for i in range(plans)], 'planCode': [f'OPP{i}' for i in range(plans)],
+                            'planName': [f'Plan {i}' for i in range(plans)], 'planTemplateId': 'template-1'})
+    meter_df = pd.DataFrame({'meterId': [f'meter-{i}' for i in range(meters)], 'meterCode': [f'MC{i}' for i in range(meters)],
+                             'meterName': [f'Meter {i}' for i in range(meters)], 'productId': 'product-1'})
+    productData_df = pd.DataFrame({'Meter_Code__c': [f'MC{i}' for i in range(meters)],
+                                   'Netsuite_Product_Id__c': [str(1000 + i) for i in range(meters)],
+                                   'IsActive': True, 'ProductCode': 'P', 'CPQ_SKU_ID__c': 'SKU',
+                                   'CPQ_SKU_Type__c': 'T', 'CPQ_SKU_Sub_Type__c': 'S'})
+    bundleData_df = pd.DataFrame({'opportunityId': [f'OPP{i}' for i in range(0, plans, 2)],
+                                  'bundle': 'bundle', 'bundleCode': 'B',
+                                  'netsuiteId': [f'NS{i}' for i in range(0, plans, 2)]})
+    return account_df, plan_df, meter_df, productData_df, bundleData_df
+
+
+def syntheticLineItems(rows, accounts=50000, plans=2000, meters=200, seed=1):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'id': [f'bill-{i // 20}' for i in range(rows)],
+                         'accountId': pd.Series(rng.integers(0, accounts, rows)).map('account-{}'.format),
+                         'accountCode': 'AC',
+                         'lineItems-quantity': rng.integers(1, 1000, rows).astype('float64'),
+                         'lineItems-usagePerPricingBand-unitPrice': rng.uniform(0.1, 2.0, rows).round(2),
+                         'lineItems-meterId': pd.Series(rng.integers(0, meters, rows)).map('meter-{}'.format),
+                         'lineItems-planId': pd.Series(rng.integers(0, plans, rows)).map('plan-{}'.format),
+                         'lastCalculatedDate': '01/11/2022'})
+
+
+def chainedMerges(lineItems, account_df, plan_df, meter_df, productData_df, bundleData_df):
+    enriched = lineItems.merge(account_df, how='left', on='accountId', suffixes=('', '_account'))
+    enriched = enriched.merge(plan_df, how='left', left_on='lineItems-planId', right_on='planId')
+    enriched = enriched.merge(meter_df, how='left', left_on='lineItems-meterId', right_on='meterId')
+    enriched = enriched.merge(productData_df, how='left', left_on='meterCode', right_on='Meter_Code__c')
+    enriched = enriched.merge(bundleData_df, how='left', left_on='planCode', right_on='opportunityId')
+    return enriched
+
+
+def indexedEnrichment(lineItems, account_df, plan_df, meter_df, productData_df, bundleData_df):
+    return main.Enrichment([
+        ('accountId', account_df, 'accountId', ['subsidiaryId']),
+        ('lineItems-planId', plan_df, 'planId', ['planCode']),
+        ('lineItems-meterId', meter_df, 'meterId', ['meterCode']),
+        ('meterCode', productData_df, 'Meter_Code__c', ['Netsuite_Product_Id__c']),
+        ('planCode', bundleData_df, 'opportunityId', ['netsuiteId']),
+    ]).apply(lineItems)
+
+
+def benchEnrich(args):
+    dimensions = syntheticDimensions()
+    for scale in args.scales:
+        lineItems = syntheticLineItems(scale)
+        report('enrich/chained merges', scale, *measure(chainedMerges, lineItems, *dimensions))
+        report('enrich/Enrichment', scale, *measure(indexedEnrichment, lineItems, *dimensions))
+        del lineItems
+
+
+# e2e - main.py run against the local stub server and a sqlite xref fixture. Each scale runs in its own process so
+# the peak RSS is that run's own; API call counts and the export time come from the run report.
+def benchE2E(args):
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.makedirs(os.path.join(workdir, 'logs'))
+            database = xrefFixture('sqlite:///' + os.path.join(workdir, 'xref.db'))
+            reportPath = os.path.join(workdir, 'runReport.json')
+            with StubServer(syntheticDataset(scale, accounts=args.accounts), latency=args.latency,
+                            errorRate=args.error_rate, pageSize=args.page_size) as stub:
+                env = dict(os.environ, M3TER_API_URL=stub.url, ORGANIZATION='stub', apiKey='stub', apiSecret='stub',
+                           DATABASE_URL=database, currentSchemaName='main', LOG_LEVEL='WARNING',
+                           XREF_SNAPSHOT_PATH='' if args.no_snapshot else os.path.join(workdir, 'xref'),
+                           RUN_REPORT_PATH=reportPath)
+                start = time.perf_counter()
+                subprocess.run([sys.executable, os.path.abspath(main.__file__)], cwd=workdir, env=env, check=True)
+                elapsed = time.perf_counter() - start
+            with open(reportPath) as file:
+                runReport = json.load(file)
+        totals = runReport['apiTotals']
+        print(json.dumps({'benchmark': 'e2e', 'scale': scale, 'seconds': round(elapsed, 3),
+                          'exportSeconds': runReport['seconds'], 'apiCalls': totals.get('calls', 0),
+                          'pages': totals.get('pages', 0), 'retries': totals.get('retries', 0),
+                          'bytesReceived': totals.get('bytesReceived', 0), 'peakRssMB': runReport['peakRssMb'],
+                          'rowsExported': runReport['stages'][-1]['rowsOut'],
+                          'stages': {stage['name']: stage['seconds'] for stage in runReport['stages']}}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the bill export pipeline")
+    commands = parser.add_subparsers(dest='command', required=True)
+    flatten = commands.add_parser('flatten', help='line item preparation: json_normalize vs flatten + concat + join')
+    flatten.add_argument('--scales', type=int, nargs='+', default=[10000, 100000, 1000000],
+                         help='number of line items')
+    flatten.set_defaults(run=benchFlatten)
+    measurements = commands.add_parser('measurements', help='measurement memory and serialisation throughput')
+    measurements.add_argument('--scales', type=int, nargs='+', default=[100000, 1000000],
+                              help='number of measurements')
+    measurements.set_defaults(run=benchMeasurements)
+    enrich = commands.add_parser('enrich', help='enrichment: chained merges vs main.Enrichment')
+    enrich.add_argument('--scales', type=int, nargs='+', default=[100000, 1000000], help='number of line items')
+    enrich.set_defaults(run=benchEnrich)
+    e2e = commands.add_parser('e2e', help='end-to-end export against the local stub server')
+    e2e.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000], help='number of line items')
+    e2e.add_argument('--latency', type=float, default=0.005, help='seconds the stub adds to every request')
+    e2e.add_argument('--error-rate', type=float, default=0.0, help='share of requests the stub answers with a 429')
+    e2e.add_argument('--page-size', type=int, default=100)
+    e2e.add_argument('--accounts', type=int, default=500)
+    e2e.add_argument('--no-snapshot', action='store_true', help='read the xref tables from the database every run')
+    e2e.set_defaults(run=benchE2E)
+    args = parser.parse_args()
+    args.run(args)
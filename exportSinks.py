@@ -0,0 +1,228 @@
+import io
+import os
+import gzip
+from urllib.parse import urlparse
+
+try:
+    import zstandard
+except ImportError:  # optional - only needed for zstd compressed CSV
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional - only needed for Parquet output
+    pyarrow = None
+
+try:
+    import boto3
+except ImportError:  # optional - only needed for s3:// targets
+    boto3 = None
+
+"""
+Export sinks for the bill extracts.
+A sink is opened once per output and written to chunk by chunk, so an export never needs the whole frame serialised
+in memory. Targets are local paths or s3://bucket/key; S3 output is streamed as a multipart upload, e.g.
+
+    with openSink('s3://exports/2022-11-01/dataExfiltration', format='csv', compression='gzip') as sink:
+        for chunk in chunks:
+            sink.write(chunk)
+"""
+
+MB = 1024 * 1024
+EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet'}
+COMPRESSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+class S3Upload(io.RawIOBase):
+    # Writable binary stream that uploads to S3 as a multipart upload, one part per partSize bytes (S3's minimum part
+    # size is 5MB). Nothing is uploaded for an empty stream until close(), which then does a single put. Any error
+    # before close() aborts the upload, so no partial object is ever visible. endpointUrl points it at an S3
+    # compatible store (MinIO, a local stand-in); S3_ENDPOINT_URL is used when it is not given.
+    def __init__(self, bucket, key, partSize=8 * MB, client=None, endpointUrl=None):
+        super().__init__()
+        if client is None:
+            if boto3 is None:
+                raise ImportError('boto3 is required for s3:// export targets: pip install boto3')
+            client = boto3.client('s3', endpoint_url=endpointUrl or os.getenv('S3_ENDPOINT_URL') or None)
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.partSize = max(partSize, 5 * MB)
+        self.buffer = bytearray()
+        self.parts = []
+        self.uploadId = None
+        self.written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        self.written += len(data)
+        while len(self.buffer) >= self.partSize:
+            self._uploadPart(bytes(self.buffer[:self.partSize]))
+            del self.buffer[:self.partSize]
+        return len(data)
+
+    def _uploadPart(self, body):
+        if self.uploadId is None:
+            self.uploadId = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+                                           PartNumber=number, Body=body)
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.uploadId is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            else:
+                if self.buffer:
+                    self._uploadPart(bytes(self.buffer))
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId,
+                                                      MultipartUpload={'Parts': self.parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.buffer = bytearray()
+            super().close()
+
+    def abort(self):
+        if self.uploadId is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.uploadId)
+            self.uploadId = None
+        self.buffer = bytearray()
+        super().close()
+
+
+def openTarget(target, client=None):
+    # Binary output stream for a local path or an s3://bucket/key url
+    if target.startswith('s3://'):
+        parsed = urlparse(target)
+        return S3Upload(parsed.netloc, parsed.path.lstrip('/'), client=client)
+    directory = os.path.dirname(target)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return open(target, 'wb')
+
+
+def compress(raw, compression):
+    if compression is None:
+        return raw
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstandard is required for zstd compression: pip install zstandard')
+        return zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+    raise ValueError(f'Unknown compression: {compression}')
+
+
+class ExportSink:
+    # Base sink: write() takes one DataFrame chunk at a time, close() finishes the output. rows counts what was
+    # written. Used as a context manager, an exception aborts an S3 upload instead of completing it.
+    def __init__(self, target, client=None):
+        self.target = target
+        self.raw = openTarget(target, client)
+        self.rows = 0
+
+    def write(self, frame):
+        raise NotImplementedError
+
+    def close(self):
+        self.raw.close()
+
+    def abort(self):
+        if isinstance(self.raw, S3Upload):
+            self.raw.abort()
+        else:
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CsvSink(ExportSink):
+    # CSV with the header written once, optionally gzip or zstd compressed on the fly
+    def __init__(self, target, compression=None, client=None):
+        super().__init__(target, client)
+        self.compressed = compress(self.raw, compression)
+        self.text = io.TextIOWrapper(self.compressed, encoding='utf-8', newline='', write_through=True)
+        self.header = True
+
+    def write(self, frame):
+        frame.to_csv(self.text, index=False, header=self.header)
+        self.header = False
+        self.rows += len(frame)
+
+    def close(self):
+        self.text.flush()
+        self.text.detach()
+        if self.compressed is not self.raw:
+            self.compressed.close()
+        self.raw.close()
+
+
+class ParquetSink(ExportSink):
+    # One row group per chunk; the schema is fixed by the first chunk and later chunks are cast to it. Columns that are
+    # all null in the first chunk are typed as strings, so a later chunk with values still fits.
+    def __init__(self, target, compression=None, client=None):
+        if pyarrow is None:
+            raise ImportError('pyarrow is required for Parquet exports: pip install pyarrow')
+        super().__init__(target, client)
+        self.compression = compression or 'snappy'
+        self.writer = None
+
+    def write(self, frame):
+        if self.writer is None:
+            table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+            schema = table.schema
+            for position, field in enumerate(schema):
+                if pyarrow.types.is_null(field.type):
+                    schema = schema.set(position, field.with_type(pyarrow.string()))
+            table = table.cast(schema)
+            self.writer = pyarrow.parquet.ParquetWriter(self.raw, schema, compression=self.compression)
+        else:
+            table = pyarrow.Table.from_pandas(frame, schema=self.writer.schema, preserve_index=False)
+        self.writer.write_table(table)
+        self.rows += len(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.raw.close()
+
+
+def exportPath(base, name, format='csv', compression=None):
+    # Full target for an export: base directory or s3:// prefix + name + format and compression extensions. Parquet
+    # compresses internally, so its name never gets a compression extension.
+    suffix = EXTENSIONS[format] + (COMPRESSIONS[compression] if format == 'csv' else '')
+    return base.rstrip('/') + '/' + name + suffix
+
+
+def openSink(target, format='csv', compression=None, client=None):
+    if format == 'csv':
+        return CsvSink(target, compression=compression, client=client)
+    if format == 'parquet':
+        return ParquetSink(target, compression=compression, client=client)
+    raise ValueError(f'Unknown export format: {format}')
+
+
+def writeFrame(frame, target, format='csv', compression=None, chunkSize=100000, client=None):
+    # Writes an existing frame chunkSize rows at a time, so only one chunk is serialised at once
+    with openSink(target, format, compression, client) as sink:
+        for start in range(0, len(frame), chunkSize):
+            sink.write(frame.iloc[start:start + chunkSize])
+        if len(frame) == 0:
+            sink.write(frame)
+    return sink.rows
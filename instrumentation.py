@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+import m3terSDK as m3ter
+
+try:
+    import resource
+except ImportError:  # not available on Windows - peak RSS is then left out of the report
+    resource = None
+
+"""
+Run instrumentation for the export jobs.
+A RunReport times each stage of a run (rows in / out, memory) and collects the m3ter API counters per entity class,
+then writes everything as one JSON document so runs can be compared and regressions caught, e.g.
+
+    report = RunReport('dataExfiltration')
+    with report.stage('flatten', rowsIn=len(bills)) as stage:
+        frame = flatten(bills)
+        stage.rowsOut = len(frame)
+    report.write('logs/runReport.json')
+"""
+
+MB = 1024 * 1024
+
+
+def peakRssMb():
+    # Process high-water mark of resident memory; ru_maxrss is in KB on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (MB if sys.platform == 'darwin' else 1024), 1)
+
+
+def rowCount(value):
+    if isinstance(value, tuple):
+        return sum(rowCount(item) or 0 for item in value)
+    return len(value) if hasattr(value, '__len__') else None
+
+
+class Stage:
+    def __init__(self, name, rowsIn=None):
+        self.name = name
+        self.rowsIn = rowsIn
+        self.rowsOut = None
+        self.seconds = None
+        self.error = None
+        self.memory = {}
+
+    def todict(self):
+        stage = {'name': self.name, 'seconds': round(self.seconds, 4), 'rowsIn': self.rowsIn, 'rowsOut': self.rowsOut}
+        stage.update(self.memory)
+        if self.error:
+            stage['error'] = self.error
+        return stage
+
+
+class RunReport:
+    # traceMemory=True also records each stage's traced allocation peak with tracemalloc. That is exact but slows
+    # allocation-heavy stages down noticeably, so by default only the process peak RSS is recorded. Stages running
+    # on several threads at once share the traced peak.
+    def __init__(self, job, traceMemory=False, **meta):
+        self.job = job
+        self.meta = meta
+        self.traceMemory = traceMemory
+        self.stages = []
+        self.startedAt = datetime.datetime.now(datetime.timezone.utc)
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        if traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        m3ter.apiMetrics.reset()
+        m3ter.apiMetrics.enable()
+
+    @contextmanager
+    def stage(self, name, rowsIn=None):
+        stage = Stage(name, rowsIn)
+        if self.traceMemory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield stage
+        except Exception as error:
+            stage.error = repr(error)
+            raise
+        finally:
+            stage.seconds = time.perf_counter() - start
+            if self.traceMemory:
+                current, peak = tracemalloc.get_traced_memory()
+                stage.memory['allocatedMb'] = round((current - before) / MB, 1)
+                stage.memory['peakTracedMb'] = round((peak - before) / MB, 1)
+            stage.memory['peakRssMb'] = peakRssMb()
+            with self._lock:
+                self.stages.append(stage)
+
+    def addStages(self, stages, prefix=''):
+        # Merges stage dicts recorded elsewhere, e.g. by a RunReport in a worker process
+        for recorded in stages:
+            recorded = dict(recorded)
+            stage = Stage(prefix + recorded.pop('name'), recorded.pop('rowsIn', None))
+            stage.rowsOut = recorded.pop('rowsOut', None)
+            stage.seconds = recorded.pop('seconds', 0.0)
+            stage.error = recorded.pop('error', None)
+            stage.memory = recorded
+            with self._lock:
+                self.stages.append(stage)
+
+    def timed(self, name=None, rowsIn=None):
+        # Decorator form of stage(); rowsOut is taken from the length of the result (summed over a tuple)
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name or function.__name__, rowsIn=rowsIn) as stage:
+                    result = function(*args, **kwargs)
+                    stage.rowsOut = rowCount(result)
+                return result
+            return wrapper
+        return decorator
+
+    def todict(self):
+        api = m3ter.apiMetrics.snapshot()
+        totals = {}
+        for counters in api.values():
+            for key, value in counters.items():
+                totals[key] = round(totals.get(key, 0) + value, 1)
+        with self._lock:
+            stages = [stage.todict() for stage in self.stages]
+        return dict({'job': self.job, 'startedAt': self.startedAt.isoformat(),
+                     'seconds': round(time.perf_counter() - self._started, 4), 'peakRssMb': peakRssMb(),
+                     'stages': stages, 'api': api, 'apiTotals': totals}, **self.meta)
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.todict(), file, indent=2, default=str)
+        return path
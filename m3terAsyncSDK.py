@@ -0,0 +1,485 @@
+import os
+import json
+import time
+import asyncio
+import datetime
+import threading
+import pandas as pd
+from urllib.parse import urlencode
+import m3terSDK as m3ter
+
+try:
+    import aiohttp
+except ImportError:  # optional - only needed when the async client is used
+    aiohttp = None
+
+"""
+asyncio variant of the m3terSDK entity classes.
+Each class mirrors its blocking counterpart in m3terSDK (same constructor and fields) but every API call is a
+coroutine on a shared aiohttp session. The number of requests in flight is capped by the transport's concurrency
+limit, so thousands of calls can be fanned out from one event loop, e.g.
+
+    bills = await asyncio.gather(*[Bill().getAccountBill(accountId) for accountId in accountIds])
+"""
+
+
+class AsyncTransport:
+    # One aiohttp session per event loop, with a connection pool and a semaphore both sized to `concurrency`
+    def __init__(self, concurrency=50, timeout=60):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+        self._loop = None
+
+    def _ensure(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            if aiohttp is None:
+                raise ImportError('aiohttp is required for the async m3ter client: pip install aiohttp')
+            self._discard()
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=30)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._loop = loop
+        return self._session
+
+    def _discard(self):
+        # Closes the session of an earlier event loop, which cannot be awaited from this one: a loop still running on
+        # another thread is asked to close it, an idle loop runs the close on a helper thread. A loop that is already
+        # closed took its transports with it, so the session is only detached and its sockets are released when the
+        # connector is collected - close the transport (or use it as an async context manager) before a loop ends.
+        session, loop = self._session, self._loop
+        self._session = None
+        if session is None or session.closed:
+            return
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+        elif loop is not None and not loop.is_closed():
+            closer = threading.Thread(target=loop.run_until_complete, args=(session.close(),), name='asyncTransportClose')
+            closer.start()
+            closer.join()
+        else:
+            session.detach()
+
+    async def request(self, action, url, headers=None, data=None):
+        session = self._ensure()
+        async with self._semaphore:
+            async with session.request(action, url, headers=headers, data=data) as response:
+                return response.status, await response.text(), response.headers.get('Retry-After')
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            if self._loop is asyncio.get_running_loop():
+                await self._session.close()
+            else:
+                self._discard()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+transport = AsyncTransport(concurrency=int(os.getenv('M3TER_ASYNC_CONCURRENCY', '50')),
+                           timeout=float(os.getenv('M3TER_TIMEOUT', '60')))
+
+
+def configureTransport(concurrency=None, timeout=None):
+    # Takes effect for the next session; call before the first request or after transport.close()
+    if concurrency is not None:
+        transport.concurrency = concurrency
+    if timeout is not None:
+        transport.timeout = timeout
+    return transport
+
+
+async def getToken():
+    # The token provider is shared with m3terSDK; a fetch or refresh runs off the event loop
+    if m3ter.tokenProvider.needsRefresh():
+        return await asyncio.to_thread(m3ter.tokenProvider.get)
+    return m3ter.tokenProvider.get()
+
+
+async def acquire(limit):
+    # Waits for the endpoint's token bucket and concurrency slot (shared with m3terSDK's threads) without blocking
+    # the event loop
+    if limit.bucket:
+        wait = limit.bucket.take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = limit.bucket.take()
+    if limit.slots:
+        while not limit.slots.acquire(blocking=False):
+            await asyncio.sleep(0.01)
+
+
+async def executeAPI(action, token=None, url=None, payload=None, idempotent=None, policy=None):
+    # Same request path as m3terSDK.executeAPI: the retries, circuit breaker and per-endpoint limits are decided by
+    # m3terSDK.executor (see RequestAttempts) and only the sending and waiting are done here. policy overrides
+    # m3terSDK.executor.policy for this call.
+    attempts = m3ter.executor.attempts(action, url, policy, idempotent, useProvider=token is None)
+    while True:
+        attempts.begin()
+        bearer = await getToken() if attempts.useProvider else token
+        headers = {
+            'Authorization': 'Bearer ' + bearer,
+            'Content-Type': 'application/json'
+        }
+        logged = m3ter.requestLog.enabled()
+        await acquire(attempts.limit)
+        started = time.perf_counter()
+        try:
+            status, text, retryAfter = await transport.request(action, url, headers=headers, data=payload or None)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+            if logged:
+                m3ter.requestLog.record(action, url, attempts.endpoint, None, time.perf_counter() - started, payload,
+                                        attempt=attempts.attempt + 1, error=error)
+            delay = attempts.failed(error, timeout=isinstance(error, asyncio.TimeoutError),
+                                    unsent=isinstance(error, aiohttp.ClientConnectorError))
+        else:
+            if logged:
+                m3ter.requestLog.record(action, url, attempts.endpoint, status, time.perf_counter() - started, payload,
+                                        text, attempt=attempts.attempt + 1)
+            delay = attempts.responded(status, retryAfter, bearer)
+            if delay is None:
+                return status, text
+        finally:
+            if attempts.limit.slots:
+                attempts.limit.slots.release()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class AsyncM3terAPI:
+    async def _call(self, action, url, payload=None, idempotent=None, policy=None):
+        status, text = await executeAPI(action=action, url=url, payload=payload, idempotent=idempotent, policy=policy)
+        return status, text
+
+    async def create(self):
+        url = m3ter.root_api_url + self.class_url
+        status, text = await self._call("POST", url, json.dumps(self.__dict__))
+        self.invalidateIndex()
+        return json.loads(text)
+
+    async def list(self, nextToken=None, params=None):
+        query = dict(params) if params else {}
+        if nextToken:
+            query['nextToken'] = nextToken
+        url = m3ter.root_api_url + self.class_url
+        if query:
+            url = url + '?' + urlencode(query)
+        status, text = await self._call("GET", url)
+        results = json.loads(text)
+        if m3ter.apiMetrics.enabled:
+            m3ter.apiMetrics.page(self.__class__.__name__, len(results.get('data') or []))
+        return results
+
+    async def get(self):
+        url = m3ter.root_api_url + self.class_url + "/" + self.id
+        status, text = await self._call("GET", url)
+        return json.loads(text)
+
+    async def delete(self):
+        url = m3ter.root_api_url + self.class_url + "/" + self.id
+        status, text = await self._call("DELETE", url)
+        self.invalidateIndex()
+        return json.loads(text)
+
+    async def update(self):
+        url = m3ter.root_api_url + self.class_url + "/" + self.id
+        status, text = await self._call("PUT", url)
+        self.invalidateIndex()
+        return json.loads(text)
+
+    async def iterPages(self, params=None):
+        # Async generator over the pages of the collection, see m3terSDK.M3terAPI.iterPages
+        next_token = None
+        paging = True
+        while paging:
+            results = await self.list(nextToken=next_token, params=params)
+            if results.get('data'):
+                yield results['data']
+            next_token = results.get('nextToken')
+            paging = bool(next_token)
+
+    async def iterObjects(self, params=None):
+        async for page in self.iterPages(params=params):
+            for object in page:
+                yield object
+
+    async def load(self, silent=False, params=None, useCache=True):
+        # Same cache as m3terSDK.M3terAPI.load: useCache=False always downloads and overwrites the cache entry
+        cache = m3ter.cache
+        cacheKey = self.cacheKey(params) if cache is not None and self.cacheTtl else None
+        objects = cache.get(cacheKey, self.cacheTtl) if cacheKey and useCache else None
+
+        if objects is None:
+            objects = [object async for object in self.iterObjects(params=params)]
+            if cacheKey: cache.put(cacheKey, objects)
+        elif not silent:
+            m3ter.printme(self.__class__.__name__ + '(s) served from cache', color='yellow', dots=True)
+
+        if not silent: m3ter.printme('#' + self.__class__.__name__ + '(s): ' + str(len(objects)), color='yellow',
+                                     dots=True)
+        return objects
+
+    async def index(self, refresh=False):
+        # Shares the per-class index with m3terSDK; the lock is not held while the collection downloads
+        cls = self.__class__
+        with m3ter._indexLock:
+            entityIndex = m3ter._indexes.get(cls)
+        if entityIndex is None or refresh:
+            entityIndex = m3ter.EntityIndex(await self.load(silent=True, useCache=not refresh))
+            with m3ter._indexLock:
+                m3ter._indexes[cls] = entityIndex
+        return entityIndex
+
+    async def refreshIndex(self):
+        return await self.index(refresh=True)
+
+    async def codeGet(self, code):
+        return (await self.index()).byCode.get(code)
+
+    async def nameGet(self, name):
+        return (await self.index()).byName.get(name)
+
+    async def idGet(self, id):
+        return (await self.index()).byId.get(id)
+
+    async def codeGetMany(self, codes):
+        byCode = (await self.index()).byCode
+        return {code: byCode.get(code) for code in codes}
+
+    async def nameGetMany(self, names):
+        byName = (await self.index()).byName
+        return {name: byName.get(name) for name in names}
+
+
+async def runPlan(planner, startDate, endDate, accounts, fetch):
+    # Async m3terSDK.QueryPlanner.run: fetch(shard) is a coroutine returning row dicts, at most planner.maxWorkers
+    # shards are in flight and a shard that times out is halved and both halves are queued again
+    accounts = list(accounts) if accounts is not None else None
+    semaphore = asyncio.Semaphore(planner.maxWorkers)
+
+    async def bounded(shard):
+        async with semaphore:
+            return await fetch(shard)
+
+    rows = []
+    splits = 0
+    pending = {asyncio.ensure_future(bounded(shard)): shard for shard in planner.plan(startDate, endDate, accounts)}
+    shards = len(pending)
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                shard = pending.pop(future)
+                try:
+                    rows.extend(future.result())
+                except Exception as error:
+                    halves = planner.split(shard) if m3ter.isTimeout(error) else None
+                    if halves is None:
+                        raise
+                    splits += 1
+                    shards += len(halves)
+                    for half in halves:
+                        pending[asyncio.ensure_future(bounded(half))] = half
+    finally:
+        for future in pending:
+            future.cancel()
+    m3ter.printme(f'Query ran {shards} shard(s), {splits} split after timing out, {len(rows)} row(s)', color='yellow',
+                  dots=True)
+    return pd.DataFrame.from_records(rows)
+
+
+class Product(AsyncM3terAPI, m3ter.Product):
+    pass
+
+
+class Meter(AsyncM3terAPI, m3ter.Meter):
+    async def create(self, dataFields, derivedFields):
+        self.dataFields = dataFields
+        self.derivedFields = derivedFields if derivedFields is not None else []
+        url = m3ter.root_api_url + self.class_url
+        status, text = await self._call("POST", url, json.dumps(self.__dict__))
+        self.invalidateIndex()
+        return json.loads(text)
+
+
+class Aggregation(AsyncM3terAPI, m3ter.Aggregation):
+    async def update(self, version=1, segmentedFields=[], segments=[]):
+        self.segmentedFields = segmentedFields
+        self.segments = segments
+        self.version = version
+        url = m3ter.root_api_url + self.class_url + "/" + self.id
+        status, text = await self._call("PUT", url, json.dumps(self.__dict__))
+        self.invalidateIndex()
+        return json.loads(text)
+
+
+class CompoundAggregation(AsyncM3terAPI, m3ter.CompoundAggregation):
+    pass
+
+
+class PlanTemplate(AsyncM3terAPI, m3ter.PlanTemplate):
+    pass
+
+
+class PlanGroup(AsyncM3terAPI, m3ter.PlanGroup):
+    pass
+
+
+class PlanGroupLink(AsyncM3terAPI, m3ter.PlanGroupLink):
+    pass
+
+
+class Plan(AsyncM3terAPI, m3ter.Plan):
+    pass
+
+
+class Contract(AsyncM3terAPI, m3ter.Contract):
+    pass
+
+
+class CreditType(AsyncM3terAPI, m3ter.CreditType):
+    pass
+
+
+class Credit(AsyncM3terAPI, m3ter.Credit):
+    pass
+
+
+class Pricing(AsyncM3terAPI, m3ter.Pricing):
+    async def create(self, pricingBands):
+        self.pricingBands = pricingBands
+        url = m3ter.root_api_url + self.class_url
+        status, text = await self._call("POST", url, json.dumps(self.__dict__))
+        self.invalidateIndex()
+        return json.loads(text)
+
+
+class Account(AsyncM3terAPI, m3ter.Account):
+    async def create(self, address=None, customFields=None):
+        if address:
+            self.address = address
+        if customFields:
+            self.customFields = customFields
+        url = m3ter.root_api_url + self.class_url
+        status, text = await self._call("POST", url, json.dumps(self.__dict__))
+        self.invalidateIndex()
+        return json.loads(text)
+
+    async def update(self, version=1, parentAccountId=None):
+        if parentAccountId:
+            self.parentAccountId = parentAccountId
+        self.version = version
+        url = m3ter.root_api_url + self.class_url + "/" + self.id
+        status, text = await self._call("PUT", url, json.dumps(self.__dict__))
+        self.invalidateIndex()
+        return json.loads(text)
+
+
+class AccountPlan(AsyncM3terAPI, m3ter.AccountPlan):
+    pass
+
+
+class Commitment(AsyncM3terAPI, m3ter.Commitment):
+    pass
+
+
+class Measure(AsyncM3terAPI, m3ter.Measure):
+    async def send(self, measurementData):
+        self.measurements = measurementData
+        url = m3ter.ingest_api_url + self.class_url
+        status, text = await self._call("POST", url, m3ter.dumps(self.__dict__),
+                                        idempotent=all(m3ter.hasUid(measurement) for measurement in measurementData))
+        return json.loads(text)
+
+    async def ingest(self, measurements, **options):
+        # The batched ingest runs on its own thread pool (m3terSDK.IngestPipeline), so it is run off the event loop
+        return await asyncio.to_thread(m3ter.Measure.ingest, self, measurements, **options)
+
+    async def ingestFrom(self, source, mapping, constants=None, chunkSize=100000, parseTimestamps=True, **options):
+        return await asyncio.to_thread(m3ter.Measure.ingestFrom, self, source, mapping, constants, chunkSize,
+                                       parseTimestamps, **options)
+
+    async def getMeasureForAgg(self, aggregationId, startDate, endDate, accountCode, policy=None):
+        url = m3ter.root_api_url + self.class_url + "/aggregations/" + aggregationId + '?' + urlencode(
+            {'startDate': startDate, 'endDate': endDate, 'accountCode': accountCode})
+        status, text = await self._call("GET", url, policy=policy)
+        return json.loads(text)
+
+    async def getMeasureForAggFrame(self, aggregationId, startDate, endDate, accountCodes, shardDays=7, maxWorkers=8):
+        async def fetch(shard):
+            result = await self.getMeasureForAgg(aggregationId, m3ter.formatTimestamp(shard.start),
+                                                 m3ter.formatTimestamp(shard.end), shard.accounts[0],
+                                                 policy=m3ter.shardPolicy)
+            return [dict(value, accountCode=shard.accounts[0]) for value in result.get('values', [])]
+
+        planner = m3ter.QueryPlanner(shardDays=shardDays, accountsPerShard=1, maxWorkers=maxWorkers)
+        return await runPlan(planner, startDate, endDate, accountCodes, fetch)
+
+
+class LineItem(AsyncM3terAPI, m3ter.LineItem):
+    pass
+
+
+class Bill(AsyncM3terAPI, m3ter.Bill):
+    async def loadForBillDate(self, billDate, endDate=None, pageSize=200):
+        # Async generator over pages of bills with billDate in [billDate, endDate), see m3terSDK.Bill
+        if isinstance(billDate, str):
+            billDate = datetime.date.fromisoformat(billDate)
+        if endDate is None:
+            endDate = billDate + datetime.timedelta(days=1)
+        elif isinstance(endDate, str):
+            endDate = datetime.date.fromisoformat(endDate)
+        params = {'billDateStart': billDate.isoformat(), 'billDateEnd': endDate.isoformat(), 'pageSize': pageSize}
+        async for page in self.iterPages(params=params):
+            yield page
+
+    async def getAccountBill(self, accountId):
+        url = m3ter.root_api_url + self.class_url + "/accountid/" + accountId
+        status, text = await self._call("GET", url)
+        return json.loads(text)['data']
+
+
+class Billjob(AsyncM3terAPI, m3ter.Billjob):
+    pass
+
+
+class Alert(AsyncM3terAPI, m3ter.Alert):
+    pass
+
+
+class ExternalMapping(AsyncM3terAPI, m3ter.ExternalMapping):
+    pass
+
+
+class OrganizationConfig(AsyncM3terAPI, m3ter.OrganizationConfig):
+    async def get(self):
+        url = m3ter.root_api_url + self.class_url
+        status, text = await self._call("GET", url)
+        return json.loads(text)
+
+
+class UsageData(AsyncM3terAPI, m3ter.UsageData):
+    async def query(self, query, policy=None):
+        url = m3ter.root_api_url + self.class_url
+        status, text = await self._call("POST", url, json.dumps(query), idempotent=True, policy=policy)
+        return json.loads(text)
+
+    async def queryFrame(self, query, shardDays=7, accountsPerShard=50, maxWorkers=8):
+        async def fetch(shard):
+            shardQuery = dict(query, startDate=m3ter.formatTimestamp(shard.start),
+                              endDate=m3ter.formatTimestamp(shard.end))
+            if shard.accounts is not None:
+                shardQuery['accountIds'] = list(shard.accounts)
+            result = await self.query(shardQuery, policy=m3ter.shardPolicy)
+            return result.get('data', []) if isinstance(result, dict) else result
+
+        planner = m3ter.QueryPlanner(shardDays=shardDays, accountsPerShard=accountsPerShard, maxWorkers=maxWorkers)
+        return await runPlan(planner, query['startDate'], query['endDate'], query.get('accountIds'), fetch)
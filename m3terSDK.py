@@ -1,13 +1,32 @@
 import os
+import time
+import random
+import sqlite3
+import hashlib
 import requests
+import threading
 import datetime
 import json
+import math
+import numpy as np
 import pandas as pd
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import logging
+from urllib.parse import urlencode, urlparse
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from dotenv import load_dotenv
 from sqlalchemy import create_engine
 import psycopg2
 
+try:
+    import orjson
+except ImportError:  # optional - faster JSON encoding for measurement ingestion
+    orjson = None
+
 """
 This is a fork of the m3terSDK from the Customer Onboarding Framework project
 It has been modified as per the project requirements.
@@ -15,56 +34,559 @@ You can find the original SDK here: https://github.com/m3ter-labs/customer-onboa
 """
 
 logger = logging.getLogger()
-logfile = None
 
 # load_dotenv("config/config.env")
 load_dotenv("config/config_prod.env")
 
 # Set up key variables that are used in all classes and methods
-ENVIRONMENT = os.getenv('ENVIRONMENT')
-ORGANIZATION = os.getenv('ORGANIZATION')
+ENVIRONMENT = os.getenv('ENVIRONMENT', '')
+ORGANIZATION = os.getenv('ORGANIZATION', '')
 LOGGING = True
 if ENVIRONMENT == 'prod':
     root_api_url = "https://api.m3ter.com/organizations/" + ORGANIZATION
     ingest_api_url = "https://ingest.m3ter.com/organizations/" + ORGANIZATION
+    auth_url = "https://api.m3ter.com/oauth/token"
 else:
     root_api_url = "https://api." + ENVIRONMENT + ".m3ter.com/organizations/" + ORGANIZATION
     ingest_api_url = "https://ingest." + ENVIRONMENT + ".m3ter.com/organizations/" + ORGANIZATION
+    auth_url = "https://api." + ENVIRONMENT + ".m3ter.com/oauth/token"
+
+
+def configureEndpoints(apiUrl, ingestUrl=None, authUrl=None):
+    # Points the SDK at another m3ter-compatible host, e.g. a local stand-in (see stubServer.py). ingestUrl defaults
+    # to apiUrl and authUrl to apiUrl + '/oauth/token'. Also set from M3TER_API_URL / M3TER_INGEST_URL /
+    # M3TER_AUTH_URL at import.
+    global root_api_url, ingest_api_url, auth_url
+    apiUrl = apiUrl.rstrip('/')
+    root_api_url = apiUrl + "/organizations/" + ORGANIZATION
+    ingest_api_url = (ingestUrl or apiUrl).rstrip('/') + "/organizations/" + ORGANIZATION
+    auth_url = authUrl or apiUrl + "/oauth/token"
+
+
+if os.getenv('M3TER_API_URL'):
+    configureEndpoints(os.getenv('M3TER_API_URL'), os.getenv('M3TER_INGEST_URL'), os.getenv('M3TER_AUTH_URL'))
+
+
+class Transport:
+    # Shared, pooled HTTP transport. One requests.Session is kept per process so every call to api.m3ter.com and
+    # ingest.m3ter.com reuses a kept-alive connection from the pool instead of doing a fresh TCP+TLS handshake.
+    # poolSize is the number of connections kept per host and should be at least the number of threads issuing
+    # calls concurrently.
+    def __init__(self, poolSize=10, timeout=60):
+        self.poolSize = poolSize
+        self.timeout = timeout
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.poolSize, pool_block=True)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    session.headers.update({'Connection': 'keep-alive'})
+                    self._session = session
+        return self._session
+
+    def request(self, action, url, headers=None, data=None, auth=None):
+        return self.session.request(action, url, headers=headers, data=data, auth=auth, timeout=self.timeout)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+transport = Transport(poolSize=int(os.getenv('M3TER_POOL_SIZE', '10')),
+                      timeout=float(os.getenv('M3TER_TIMEOUT', '60')))
+
+
+def configureTransport(poolSize=None, timeout=None):
+    # Resize the shared pool, e.g. before fanning calls out over a thread pool. Open connections are dropped.
+    if poolSize is not None:
+        transport.poolSize = poolSize
+    if timeout is not None:
+        transport.timeout = timeout
+    transport.close()
+    return transport
+
+
+def requestToken(username, password):
+    # Goes through the executor like every other call, so a 429 / 5xx from the token endpoint is retried with backoff
+    # instead of failing the run; asking for a token again is harmless, so the POST is idempotent
+    data_raw = '{"grant_type": "client_credentials"}'
+    response = executor.execute("POST", auth_url, payload=data_raw, idempotent=True, auth=(username, password))
+    return response.json()
 
 
 def getToken(username, password):
-    headers = {
-        'Content-Type': 'application/json'
-    }
-    if ENVIRONMENT == 'prod':
-        url = "https://api.m3ter.com/oauth/token"
-    else:
-        url = "https://api." + ENVIRONMENT + ".m3ter.com/oauth/token"
+    return requestToken(username, password).get('access_token')
 
-    data_raw = '{"grant_type": "client_credentials"}'
-    response = requests.post(url=url, headers=headers, auth=(username, password), data=data_raw)
-    return response.json().get('access_token')
 
+class TokenProvider:
+    # Fetches the access token on first use rather than at import, caches it with its expiry and fetches a new one
+    # refreshAhead seconds before it expires. One provider is shared by all threads (the lock makes sure only one
+    # of them goes to the token endpoint) and, as a module global, it survives across warm Lambda invocations.
+    def __init__(self, username=None, password=None, refreshAhead=300):
+        self.username = username
+        self.password = password
+        self.refreshAhead = refreshAhead
+        self._token = None
+        self._expires = 0
+        self._lock = threading.Lock()
 
-def executeAPI(action, token, url, payload):
-    headers = {
-        'Authorization': 'Bearer ' + token,
-        'Content-Type': 'application/json'
-    }
-    response = requests.request(action, url, headers=headers, data=payload)
-    print(response.text)
-    return response
+    def needsRefresh(self):
+        return self._token is None or time.time() >= self._expires - self.refreshAhead
 
+    def get(self):
+        if self.needsRefresh():
+            with self._lock:
+                if self.needsRefresh():
+                    result = requestToken(self.username or os.getenv('apiKey'), self.password or os.getenv('apiSecret'))
+                    if not result.get('access_token'):
+                        raise RuntimeError('Unable to get an m3ter access token: ' + str(result))
+                    self._token = result['access_token']
+                    self._expires = time.time() + float(result.get('expires_in') or 3600)
+        return self._token
+
+    def invalidate(self, token=None):
+        # Forget the cached token, e.g. after a 401; passing the rejected token avoids dropping a newer one
+        with self._lock:
+            if token is None or token == self._token:
+                self._token = None
+                self._expires = 0
+
+
+tokenProvider = TokenProvider(refreshAhead=float(os.getenv('M3TER_TOKEN_REFRESH_AHEAD', '300')))
+
+
+def __getattr__(name):
+    # m3terSDK.TOKEN is still available to callers, but is now resolved lazily through the token provider
+    if name == 'TOKEN':
+        return tokenProvider.get()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class M3terAPIError(Exception):
+    # timeout is set when the request failed because the client gave up waiting for the response
+    def __init__(self, message, status=None, response=None, timeout=False):
+        super().__init__(message)
+        self.status = status
+        self.response = response
+        self.timeout = timeout
+
+
+class RetryPolicy:
+    # Exponential backoff with jitter; a Retry-After header from the API takes precedence over the computed delay.
+    # Responses with a status in failStatuses, and client-side timeouts when retryTimeouts is False, raise
+    # M3terAPIError straight away instead of being retried.
+    def __init__(self, maxAttempts=5, baseDelay=0.5, maxDelay=30.0, retryStatuses=(429, 500, 502, 503, 504),
+                 failStatuses=(), retryTimeouts=True):
+        self.maxAttempts = maxAttempts
+        self.retryTimeouts = retryTimeouts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.retryStatuses = set(retryStatuses)
+        self.failStatuses = set(failStatuses)
+
+    def delay(self, attempt, retryAfter=None):
+        if retryAfter:
+            try:
+                return min(self.maxDelay, max(0.0, float(retryAfter)))
+            except ValueError:
+                try:
+                    when = parsedate_to_datetime(retryAfter)
+                    return min(self.maxDelay, max(0.0, when.timestamp() - time.time()))
+                except (TypeError, ValueError):
+                    pass
+        backoff = min(self.maxDelay, self.baseDelay * (2 ** attempt))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+class TokenBucket:
+    # Allows `rate` requests per second on average with bursts of up to `burst`
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        # Takes a token and returns 0 if one is available, otherwise returns the seconds to wait before trying again
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        wait = self.take()
+        while wait:
+            time.sleep(wait)
+            wait = self.take()
+
+    def pause(self, seconds):
+        # Holds every caller back for about `seconds`, e.g. after a 429 with Retry-After
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate, 1 - seconds * self.rate)
+            self.updated = now
+
+
+class CircuitBreaker:
+    # Opens after failureThreshold consecutive failures, then rejects calls for resetTimeout seconds before letting a
+    # single trial call through (half open); a success closes it again
+    def __init__(self, failureThreshold=10, resetTimeout=30.0):
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.failures = 0
+        self.openedAt = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.openedAt is None:
+                return True
+            if time.monotonic() - self.openedAt >= self.resetTimeout and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.openedAt = None
+            self._trial = False
+
+    def release(self):
+        # Neither a success nor a failure (a 429 or a client error): only frees a half open trial for the next call
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.failureThreshold:
+                self.openedAt = time.monotonic()
+
+
+class EndpointLimit:
+    def __init__(self, rate=None, burst=None, concurrency=None):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+
+
+requestLogger = logging.getLogger('m3ter.requests')
+
+
+def _clip(body, limit):
+    if body is None:
+        return None
+    body = body[:limit]
+    return body.decode('utf-8', errors='replace') if isinstance(body, (bytes, bytearray)) else body
+
+
+class RequestLog:
+    # Structured request logging. Every HTTP attempt becomes one record with the method, endpoint, status, latency and
+    # bytes sent / received. Records are logged at DEBUG on the 'm3ter.requests' logger (as the `request` attribute
+    # of the log record, for structured handlers) and passed to every listener. A sampleRate share of the records also
+    # carries the url and the first maxBody characters of both bodies. With DEBUG off and no listeners, enabled() is
+    # False and the executor builds nothing.
+    def __init__(self, sampleRate=0.0, maxBody=2048):
+        self.sampleRate = sampleRate
+        self.maxBody = maxBody
+        self.listeners = []
+
+    def enabled(self):
+        return bool(self.listeners) or requestLogger.isEnabledFor(logging.DEBUG)
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+        return listener
+
+    def removeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def record(self, action, url, endpoint, status, latency, payload=None, body=None, attempt=1, error=None):
+        record = {'method': action, 'endpoint': endpoint, 'status': status, 'latencyMs': round(latency * 1000, 1),
+                  'bytesSent': len(payload) if payload else 0, 'bytesReceived': len(body) if body else 0,
+                  'attempt': attempt}
+        if error is not None:
+            record['error'] = str(error)
+        if self.sampleRate and random.random() < self.sampleRate:
+            record['url'] = url
+            record['requestBody'] = _clip(payload, self.maxBody)
+            record['responseBody'] = _clip(body, self.maxBody)
+        for listener in self.listeners:
+            listener(record)
+        if requestLogger.isEnabledFor(logging.DEBUG):
+            requestLogger.debug('%s %s %s %.1fms %dB', action, endpoint, status, record['latencyMs'],
+                                record['bytesReceived'], extra={'request': record})
+        return record
+
+
+requestLog = RequestLog(sampleRate=float(os.getenv('M3TER_LOG_BODY_SAMPLE', '0')),
+                        maxBody=int(os.getenv('M3TER_LOG_BODY_MAX', '2048')))
+
+
+class ApiMetrics:
+    # Per entity class counters of API calls, pages, objects, bytes, retries and errors, fed by a requestLog listener
+    # while enabled. Requests are attributed by endpoint, e.g. 'api/bills' counts against Bill.
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self._entities = None
+        self._lock = threading.Lock()
+
+    def enable(self):
+        if not self.enabled:
+            requestLog.addListener(self.onRequest)
+            self.enabled = True
+        return self
 
-def logWrite(logfile, entity, action, payload, status, response, url):
-    logger.debug(f'{action} {entity} .....................')
-    if payload: logfile.write('\n' + payload)
-    if status:
-        if status != 200:
-            logger.debug('\nStatus: ' + str(status))
-    if response: logger.debug('\n' + response)
-    if url:
-        logger.debug('\nURL: ' + url)
+    def disable(self):
+        requestLog.removeListener(self.onRequest)
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+
+    def entity(self, endpoint):
+        if self._entities is None:
+            entities = {}
+            pending = [M3terAPI]
+            while pending:
+                cls = pending.pop(0)
+                pending.extend(cls.__subclasses__())
+                if getattr(cls, 'class_url', None):
+                    entities[cls.class_url.split('/')[1]] = cls.__name__
+            self._entities = entities
+        return self._entities.get(endpoint.split('/', 1)[-1], endpoint)
+
+    def _counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = self.counters[name] = {'calls': 0, 'pages': 0, 'objects': 0, 'bytesSent': 0, 'bytesReceived': 0,
+                                             'retries': 0, 'errors': 0, 'latencyMs': 0.0}
+        return counter
+
+    def onRequest(self, record):
+        with self._lock:
+            counter = self._counter(self.entity(record['endpoint']))
+            counter['calls'] += 1
+            counter['bytesSent'] += record['bytesSent']
+            counter['bytesReceived'] += record['bytesReceived']
+            counter['latencyMs'] += record['latencyMs']
+            if record['attempt'] > 1:
+                counter['retries'] += 1
+            if record['status'] is None or record['status'] >= 400:
+                counter['errors'] += 1
+
+    def page(self, name, objects):
+        with self._lock:
+            counter = self._counter(name)
+            counter['pages'] += 1
+            counter['objects'] += objects
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(counter, latencyMs=round(counter['latencyMs'], 1))
+                    for name, counter in self.counters.items()}
+
+
+apiMetrics = ApiMetrics()
+
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+
+
+def unsent(error):
+    # True for connection errors raised before any of the request reached the server, so resending cannot duplicate it
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class RequestAttempts:
+    # The retry, circuit breaker and rate limit decisions for one request, shared by RequestExecutor.execute and the
+    # asyncio client (m3terAsyncSDK.executeAPI), which only differ in how they send and wait. After each attempt the
+    # caller passes the outcome to failed() or responded() and gets back the delay before the next attempt, None for
+    # a final response, or an M3terAPIError raised when the request is not retried.
+    def __init__(self, executor, action, url, policy=None, idempotent=None, useProvider=True):
+        self.action = action
+        self.url = url
+        self.policy = policy or executor.policy
+        self.idempotent = action.upper() in IDEMPOTENT_METHODS if idempotent is None else idempotent
+        self.endpoint = executor.endpoint(url)
+        self.limit = executor.limits.get(self.endpoint, executor.defaultLimit)
+        self.breaker = executor.breaker(self.endpoint)
+        self.useProvider = useProvider
+        self.refreshed = False
+        self.attempt = 0
+
+    def begin(self):
+        if not self.breaker.allow():
+            raise M3terAPIError(f'Circuit open for {self.endpoint}, not calling {self.action} {self.url}')
+
+    def failed(self, error, timeout=False, unsent=False):
+        # A connection error or timeout; unsent means none of the request reached the server
+        self.breaker.failure()
+        if not self.idempotent and not unsent:
+            raise M3terAPIError(f'{self.action} {self.url} failed, not retried as it may have been processed: {error}',
+                                timeout=timeout) from error
+        if timeout and not unsent and not self.policy.retryTimeouts:
+            raise M3terAPIError(f'{self.action} {self.url} timed out: {error}', timeout=True) from error
+        return self.retry(error, timeout=timeout)
+
+    def responded(self, status, retryAfter=None, bearer=None, response=None):
+        # A 401 drops the provider's token once and is retried straight away (delay 0)
+        if status == 401 and self.useProvider and not self.refreshed:
+            tokenProvider.invalidate(bearer)
+            self.refreshed = True
+            return 0
+        if status in self.policy.failStatuses:
+            self.breaker.release()
+            raise M3terAPIError(f'{self.action} {self.url} failed: HTTP {status}', status=status, response=response)
+        if status not in self.policy.retryStatuses:
+            self.breaker.success()
+            return None
+        failure = f'HTTP {status}'
+        if not self.idempotent and status != 429:
+            self.breaker.failure()
+            raise M3terAPIError(f'{self.action} {self.url} failed, not retried as it may have been processed: {failure}',
+                                status=status, response=response)
+        if status == 429:
+            self.breaker.release()
+        else:
+            self.breaker.failure()
+        return self.retry(failure, status, response, retryAfter, throttled=status == 429)
+
+    def retry(self, failure, status=None, response=None, retryAfter=None, throttled=False, timeout=False):
+        self.attempt += 1
+        if self.attempt >= self.policy.maxAttempts:
+            raise M3terAPIError(f'{self.action} {self.url} failed after {self.attempt} attempts: {failure}',
+                                status=status, response=response, timeout=timeout) \
+                from (failure if isinstance(failure, Exception) else None)
+        delay = self.policy.delay(self.attempt - 1, retryAfter)
+        if throttled and self.limit.bucket:
+            self.limit.bucket.pause(delay)
+        logger.warning(f'{self.action} {self.endpoint} failed ({failure}), retry {self.attempt} in {delay:.1f}s')
+        return delay
+
+
+class RequestExecutor:
+    # Central request path: per-endpoint rate / concurrency limits and circuit breaker, retries with backoff on 429,
+    # 5xx and connection errors, and a token refresh on 401. Only 5xx and connection errors count towards the
+    # breaker; a 429 backs off instead, holding the endpoint's token bucket for the Retry-After delay. Endpoints are
+    # named after the host and first path segment below the organization, e.g. 'api/bills' or 'ingest/measurements'.
+    # Non idempotent requests (POST unless the caller says otherwise) are only retried when the server cannot have
+    # processed them: after a 429 or a connection that was never made. A 5xx or a read timeout raises straight away.
+    # The decisions are made by RequestAttempts; policy is the one retry policy of both the blocking and async client.
+    def __init__(self, policy=None, failureThreshold=10, resetTimeout=30.0):
+        self.policy = policy or RetryPolicy()
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.limits = {}
+        self.defaultLimit = EndpointLimit()
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(url):
+        parsed = urlparse(url)
+        segments = parsed.path.split('/')[1:]
+        if segments and segments[0] == 'organizations':
+            segments = segments[2:]
+        host = parsed.hostname or ''
+        prefix = host.split('.')[0] if host.endswith('m3ter.com') else host
+        return prefix + '/' + (segments[0] if segments else '')
+
+    def configure(self, endpoint, rate=None, burst=None, concurrency=None):
+        # endpoint=None sets the default limit for every endpoint without its own
+        limit = EndpointLimit(rate, burst, concurrency)
+        if endpoint is None:
+            self.defaultLimit = limit
+        else:
+            self.limits[endpoint] = limit
+        return limit
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(self.failureThreshold, self.resetTimeout)
+            return self._breakers[endpoint]
+
+    def attempts(self, action, url, policy=None, idempotent=None, useProvider=True):
+        return RequestAttempts(self, action, url, policy, idempotent, useProvider)
+
+    def send(self, action, url, headers, payload, limit, auth=None):
+        if limit.bucket:
+            limit.bucket.acquire()
+        if limit.slots:
+            with limit.slots:
+                return transport.request(action, url, headers=headers, data=payload, auth=auth)
+        return transport.request(action, url, headers=headers, data=payload, auth=auth)
+
+    def execute(self, action, url, payload=None, token=None, policy=None, idempotent=None, auth=None):
+        # auth=(username, password) sends basic auth instead of a bearer token, for the token endpoint itself
+        attempts = self.attempts(action, url, policy, idempotent, useProvider=token is None and auth is None)
+        while True:
+            attempts.begin()
+            bearer = tokenProvider.get() if attempts.useProvider else token
+            headers = {
+                'Content-Type': 'application/json'
+            }
+            if bearer is not None:
+                headers['Authorization'] = 'Bearer ' + bearer
+            logged = requestLog.enabled()
+            started = time.perf_counter()
+            try:
+                response = self.send(action, url, headers, payload, attempts.limit, auth)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if logged:
+                    requestLog.record(action, url, attempts.endpoint, None, time.perf_counter() - started, payload,
+                                      attempt=attempts.attempt + 1, error=error)
+                delay = attempts.failed(error, timeout=isinstance(error, requests.Timeout), unsent=unsent(error))
+            else:
+                if logged:
+                    requestLog.record(action, url, attempts.endpoint, response.status_code,
+                                      time.perf_counter() - started, payload, response.content,
+                                      attempt=attempts.attempt + 1)
+                delay = attempts.responded(response.status_code, response.headers.get('Retry-After'), bearer,
+                                           response)
+                if delay is None:
+                    return response
+            if delay:
+                time.sleep(delay)
+
+
+retryPolicy = RetryPolicy(maxAttempts=int(os.getenv('M3TER_MAX_ATTEMPTS', '5')),
+                          maxDelay=float(os.getenv('M3TER_MAX_RETRY_DELAY', '30')))
+executor = RequestExecutor(policy=retryPolicy)
+if os.getenv('M3TER_RATE_LIMIT') or os.getenv('M3TER_ENDPOINT_CONCURRENCY'):
+    executor.configure(None, rate=float(os.getenv('M3TER_RATE_LIMIT', '0')) or None,
+                       concurrency=int(os.getenv('M3TER_ENDPOINT_CONCURRENCY', '0')) or None)
+
+
+def executeAPI(action, token=None, url=None, payload=None, policy=None, idempotent=None):
+    # Without an explicit token the shared provider's token is used. Retryable failures that persist after the
+    # retry policy's attempts raise M3terAPIError; any other response is returned to the caller as before.
+    # policy overrides the executor's RetryPolicy for this call. idempotent=True lets a POST that is safe to resend
+    # (a read-only query, measurements that all carry a uid) be retried like a GET.
+    return executor.execute(action, url, payload=payload, token=token, policy=policy, idempotent=idempotent)
 
 
 def printme(input='', color=None, dots=False, time=False):
@@ -100,15 +622,20 @@ def printme(input='', color=None, dots=False, time=False):
     elif color == 'cyan':
         input = cyan + input + end
     if DEBUG:
-        logger.debug(input)
+        logger.info(input)
 
 
-TOKEN = getToken(username=os.getenv('apiKey'), password=os.getenv('apiSecret'))
 if LOGGING:
-    logger.debug('\nEnvironment: ' + ENVIRONMENT)
-    logger.debug('\nOrganization: ' + ORGANIZATION)
-
-def openSqlAlchemy():
+    logger.debug('Environment: %s', ENVIRONMENT)
+    logger.debug('Organization: %s', ORGANIZATION)
+
+def openSqlAlchemy(poolSize=20, maxOverflow=40):
+    # DATABASE_URL, when set, replaces the db* settings, e.g. sqlite:///xref.db for a local fixture
+    if os.getenv('DATABASE_URL'):
+        url = os.getenv('DATABASE_URL')
+        if url.startswith('sqlite'):
+            return create_engine(url)
+        return create_engine(url, pool_size=poolSize, max_overflow=maxOverflow)
     dbname = os.getenv('dbname')
     options = os.getenv('dboptions')
     user = os.getenv('dbuser')
@@ -119,14 +646,14 @@ def openSqlAlchemy():
     connection_args = dict()
     connection_args['options'] = os.getenv('dboptions')
     try:
-        engine = create_engine(connection, connect_args=connection_args, pool_size=20, max_overflow=40)
+        engine = create_engine(connection, connect_args=connection_args, pool_size=poolSize, max_overflow=maxOverflow)
         return engine
     except:
         printme('SQLAlchemy - Unable to open connection for: ' + str(connection) + ' ' + str(connection_args))
         return None
 
 def openPG():
-    print('Executing function: openPG()')
+    logger.debug('Executing function: openPG()')
     connection = psycopg2.connect(dbname=os.getenv('dbname'),
                                   options=os.getenv('dboptions'),
                                   user=os.getenv('dbuser'),
@@ -134,102 +661,270 @@ def openPG():
                                   host=os.getenv('dbhost'),
                                   port=os.getenv('dbport'))
 
-    print('Connection status: ' + str(connection.closed))
+    logger.debug('Connection status: %s', connection.closed)
     return connection
 
 
+class EntityIndex:
+    # code -> id, name -> id and id -> object maps over one loaded collection. As with the original linear
+    # scans, the last object with a given code or name wins.
+    def __init__(self, objects):
+        self.byId = {}
+        self.byCode = {}
+        self.byName = {}
+        for object in objects:
+            objectId = object.get('id')
+            self.byId[objectId] = object
+            if 'code' in object:
+                self.byCode[object['code']] = objectId
+            if 'name' in object:
+                self.byName[object['name']] = objectId
+
+    def __len__(self):
+        return len(self.byId)
+
+
+_indexes = {}
+_indexLock = threading.RLock()
+
+
+def _typedSeries(values, dtype):
+    if dtype in ('Int64', 'Int32', 'float64', 'float32'):
+        return pd.Series(pd.to_numeric(pd.Series(values, dtype='object'), errors='coerce'), dtype=dtype)
+    if dtype.startswith('datetime64'):
+        return pd.to_datetime(pd.Series(values, dtype='object'), utc=True, errors='coerce')
+    if dtype == 'bool':
+        return pd.Series(values, dtype='boolean')
+    return pd.Series(values, dtype=dtype)
+
+
+class SqliteCache:
+    # On-disk cache of loaded collections, one row per entity (+ query) holding the JSON list, when it was fetched,
+    # when it was last used and a fingerprint of every object's id/version/lastModified. A refetch always downloads
+    # the whole collection; the fingerprint only spares rewriting an unchanged entry. When the total size goes
+    # above maxBytes the least recently used entries are evicted. Any object with get/put/invalidate methods of the
+    # same shape can be plugged in with setCache().
+    def __init__(self, path, maxBytes=256 * 1024 * 1024):
+        self.path = path
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS entities (key TEXT PRIMARY KEY, fetched REAL, used REAL, '
+                               'fingerprint TEXT, size INTEGER, body BLOB)')
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def fingerprint(objects):
+        digest = hashlib.sha1()
+        for object in sorted(objects, key=lambda o: str(o.get('id'))):
+            digest.update(f"{object.get('id')}|{object.get('version')}|{object.get('lastModified')}\n".encode())
+        return digest.hexdigest()
+
+    def get(self, key, ttl):
+        # Returns the cached objects if they were fetched less than ttl seconds ago, otherwise None
+        with self._lock, self._connect() as connection:
+            row = connection.execute('SELECT fetched, body FROM entities WHERE key = ?', (key,)).fetchone()
+            if row is None or time.time() - row[0] >= ttl:
+                return None
+            connection.execute('UPDATE entities SET used = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[1])
+
+    def put(self, key, objects):
+        # A refetch that matches the stored fingerprint only updates the entry's timestamps instead of rewriting it
+        fingerprint = self.fingerprint(objects)
+        now = time.time()
+        with self._lock, self._connect() as connection:
+            row = connection.execute('SELECT fingerprint FROM entities WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[0] == fingerprint:
+                connection.execute('UPDATE entities SET fetched = ?, used = ? WHERE key = ?', (now, now, key))
+                return False
+            body = json.dumps(objects)
+            connection.execute('INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, now, now, fingerprint, len(body), body))
+            self._evict(connection)
+        return True
+
+    def _evict(self, connection):
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entities').fetchone()[0]
+        for key, size in connection.execute('SELECT key, size FROM entities ORDER BY used').fetchall():
+            if total <= self.maxBytes:
+                break
+            connection.execute('DELETE FROM entities WHERE key = ?', (key,))
+            total -= size
+
+    def invalidate(self, key=None):
+        with self._lock, self._connect() as connection:
+            if key is None:
+                connection.execute('DELETE FROM entities')
+            else:
+                connection.execute('DELETE FROM entities WHERE key = ? OR key LIKE ?', (key, key + '?%'))
+
+
+# Reference data (accounts, meters, plans, products) is cached for M3TER_CACHE_TTL seconds when M3TER_CACHE_PATH is set
+REFERENCE_CACHE_TTL = float(os.getenv('M3TER_CACHE_TTL', str(6 * 60 * 60)))
+cache = None
+if os.getenv('M3TER_CACHE_PATH'):
+    cache = SqliteCache(os.getenv('M3TER_CACHE_PATH'),
+                        maxBytes=int(os.getenv('M3TER_CACHE_MAX_BYTES', str(256 * 1024 * 1024))))
+
+
+def setCache(newCache):
+    global cache
+    cache = newCache
+    return cache
+
+
 class M3terAPI:
     def create(self):
         url = root_api_url + self.class_url
         payload = json.dumps(self.__dict__)
-        response = executeAPI(action="POST", token=TOKEN, url=url, payload=payload)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Creating', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="POST", url=url, payload=payload)
+        self.invalidateIndex()
         return json.loads(response.text)
 
-    def list(self, nextToken=None):
+    def list(self, nextToken=None, params=None):
+        # params are passed through as query string filters, e.g. {'billDateStart': '2022-11-01'}
+        query = dict(params) if params else {}
         if nextToken:
-            url = root_api_url + self.class_url + '?nextToken=' + nextToken
-        else:
-            url = root_api_url + self.class_url
-        payload = None
-        response = executeAPI(action="GET", token=TOKEN, url=url, payload="")
-        if LOGGING: logWrite(logfile=logfile, entity=self.class_url[1:-1], action='Listing', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
-        return json.loads(response.text)
+            query['nextToken'] = nextToken
+        url = root_api_url + self.class_url
+        if query:
+            url = url + '?' + urlencode(query)
+        response = executeAPI(action="GET", url=url, payload="")
+        results = json.loads(response.text)
+        if apiMetrics.enabled:
+            apiMetrics.page(self.__class__.__name__, len(results.get('data') or []))
+        return results
 
     def get(self):
         url = root_api_url + self.class_url + "/" + self.id
-        payload = None
-        response = executeAPI(action="GET", token=TOKEN, url=url, payload="")
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Getting', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="GET", url=url, payload="")
         return json.loads(response.text)
 
     def delete(self):
         url = root_api_url + self.class_url + "/" + self.id
-        payload = None
-        try:
-            response = executeAPI(action="DELETE", token=TOKEN, url=url, payload="")
-        except:
-            try:
-                response = executeAPI(action="DELETE", token=TOKEN, url=url, payload="")
-            except:
-                response = executeAPI(action="DELETE", token=TOKEN, url=url, payload="")
+        response = executeAPI(action="DELETE", url=url, payload="")
+        self.invalidateIndex()
 
-        if LOGGING: logWrite(logfile=logfile, entity=self.class_url[1:-1], action='Deleting', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
         return json.loads(response.text)
 
     def update(self):
         url = root_api_url + self.class_url + "/" + self.id
-        payload = None
-        response = executeAPI(action="PUT", token=TOKEN, url=url, payload="")
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Updating', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="PUT", url=url, payload="")
+        self.invalidateIndex()
         return json.loads(response.text)
 
 
-    def load(self, silent=False):
-        next_token = None
-        paging = True
-        objects = []
-
-        while paging:
-            results = self.list(nextToken=next_token)
-            if 'data' in results:
-                for object in results['data']:
-                    objects.append(object)
-            if 'nextToken' in results:
-                next_token = results['nextToken']
-                paging = True
-            else:
-                paging = False
+    # Streaming alternative to load(): yields one page (list of objects) at a time so callers can process and drop
+    # each page before the next arrives. With prefetch=True the next page is requested on a background thread
+    # while the caller works on the current one, so at most two pages are held in memory.
+    def iterPages(self, params=None, prefetch=False):
+        if not prefetch:
+            next_token = None
+            paging = True
+            while paging:
+                results = self.list(nextToken=next_token, params=params)
+                if results.get('data'):
+                    yield results['data']
+                next_token = results.get('nextToken')
+                paging = bool(next_token)
+            return
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch') as pool:
+            future = pool.submit(self.list, None, params)
+            while future is not None:
+                results = future.result()
+                next_token = results.get('nextToken')
+                future = pool.submit(self.list, next_token, params) if next_token else None
+                if results.get('data'):
+                    yield results['data']
+
+    def iterObjects(self, params=None, prefetch=False):
+        for page in self.iterPages(params=params, prefetch=prefetch):
+            yield from page
+
+    # Schema for toFrame(): output column -> (dotted path of the field in the API object, dtype)
+    frameSchema = {'id': ('id', 'object'), 'code': ('code', 'object'), 'name': ('name', 'object'),
+                   'version': ('version', 'Int64')}
+
+    @classmethod
+    def toFrame(cls, objects, schema=None):
+        # Builds a DataFrame holding only the schema's fields, with their dtypes, in one pass over the objects
+        schema = schema or cls.frameSchema
+        paths = [(column, path.split('.')) for column, (path, dtype) in schema.items()]
+        columns = {column: [] for column in schema}
+        for object in objects:
+            for column, keys in paths:
+                value = object
+                for key in keys:
+                    value = value.get(key) if isinstance(value, dict) else None
+                columns[column].append(value)
+        return pd.DataFrame({column: _typedSeries(columns[column], schema[column][1]) for column in schema})
+
+    # Seconds a loaded collection may be served from the cache; None disables caching for the class
+    cacheTtl = None
+
+    def cacheKey(self, params=None):
+        return self.class_url + ('?' + urlencode(sorted(params.items())) if params else '')
+
+    def load(self, silent=False, params=None, useCache=True):
+        # useCache=False always downloads the collection and overwrites its cache entry
+        cacheKey = self.cacheKey(params) if cache is not None and self.cacheTtl else None
+        objects = cache.get(cacheKey, self.cacheTtl) if cacheKey and useCache else None
+
+        if objects is None:
+            objects = list(self.iterObjects(params=params))
+            if cacheKey: cache.put(cacheKey, objects)
+        elif not silent:
+            printme(self.__class__.__name__ + '(s) served from cache', color='yellow', dots=True)
 
         if not silent: printme('#' + self.__class__.__name__ + '(s): ' + str(len(objects)), color='yellow', dots=True)
         return objects
 
-    def codeGet(self, code):
-        currentId = None
-        objects = self.load(silent=True)
-        for object in objects:
-            if object['code'] == code:
-                currentId = object['id']
+    # Lookups by code / name / id are served from a per-class in-memory index built from a single load(),
+    # so resolving many codes costs one paginated download. create / update / delete drop the class's index and
+    # cache entries; refreshIndex() rebuilds the index from a fresh download after changes made elsewhere.
+    def index(self, refresh=False):
+        cls = self.__class__
+        with _indexLock:
+            entityIndex = _indexes.get(cls)
+            if entityIndex is None or refresh:
+                entityIndex = EntityIndex(self.load(silent=True, useCache=not refresh))
+                _indexes[cls] = entityIndex
+        return entityIndex
+
+    def refreshIndex(self):
+        return self.index(refresh=True)
+
+    def invalidateIndex(self):
+        with _indexLock:
+            _indexes.pop(self.__class__, None)
+        if cache is not None and self.cacheTtl:
+            cache.invalidate(self.class_url)
 
-        return currentId
+    def codeGet(self, code):
+        return self.index().byCode.get(code)
 
     def nameGet(self, name):
-        currentId = None
-        objects = self.load(silent=True)
-        for object in objects:
-            if object['name'] == name:
-                currentId = object['id']
+        return self.index().byName.get(name)
+
+    def idGet(self, id):
+        return self.index().byId.get(id)
+
+    def codeGetMany(self, codes):
+        byCode = self.index().byCode
+        return {code: byCode.get(code) for code in codes}
 
-        return currentId
+    def nameGetMany(self, names):
+        byName = self.index().byName
+        return {name: byName.get(name) for name in names}
 
 
 class Product(M3terAPI):
     class_url = "/products"
+    cacheTtl = REFERENCE_CACHE_TTL
 
     def __init__(self, name="", code="", id=""):
         self.name = name
@@ -260,6 +955,9 @@ class derivedField:
 
 class Meter(M3terAPI):
     class_url = "/meters"
+    cacheTtl = REFERENCE_CACHE_TTL
+    frameSchema = {'meterId': ('id', 'object'), 'meterCode': ('code', 'category'), 'meterName': ('name', 'object'),
+                   'productId': ('productId', 'category')}
 
     def __init__(self, productId="", name="", code="", id=""):
         if productId:
@@ -279,9 +977,8 @@ class Meter(M3terAPI):
         url = root_api_url + self.class_url
         payload = json.dumps(self.__dict__)
         # print(payload)
-        response = executeAPI(action="POST", token=TOKEN, url=url, payload=payload)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Creating', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="POST", url=url, payload=payload)
+        self.invalidateIndex()
         return json.loads(response.text)
 
 
@@ -310,10 +1007,8 @@ class Aggregation(M3terAPI):
         url = root_api_url + self.class_url + "/" + self.id
         payload = json.dumps(self.__dict__)
         # print(payload)
-        response = executeAPI(action="PUT", token=TOKEN, url=url, payload=payload)
-        print(response.text)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Updating', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="PUT", url=url, payload=payload)
+        self.invalidateIndex()
         return json.loads(response.text)
 
     def todict(self):
@@ -377,6 +1072,9 @@ class PlanGroupLink(M3terAPI):
 
 class Plan(M3terAPI):
     class_url = "/plans"
+    cacheTtl = REFERENCE_CACHE_TTL
+    frameSchema = {'planId': ('id', 'object'), 'planCode': ('code', 'category'), 'planName': ('name', 'object'),
+                   'planTemplateId': ('planTemplateId', 'category')}
 
     def __init__(self, planTemplateId="", name="", code="", accountId=None, standingCharge=0, ordinal=0, bespoke=False,
                  minimumSpend=0, id=""):
@@ -472,9 +1170,8 @@ class Pricing(M3terAPI):
         self.pricingBands = pricingBands
         url = root_api_url + self.class_url
         payload = json.dumps(self.__dict__)
-        response = executeAPI(action="POST", token=TOKEN, url=url, payload=payload)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Creating', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="POST", url=url, payload=payload)
+        self.invalidateIndex()
         return json.loads(response.text)
 
 
@@ -496,6 +1193,9 @@ class Address:
 
 class Account(M3terAPI):
     class_url = "/accounts"
+    cacheTtl = REFERENCE_CACHE_TTL
+    frameSchema = {'accountId': ('id', 'object'), 'accountCode': ('code', 'object'), 'accountName': ('name', 'object'),
+                   'subsidiaryId': ('customFields.subsidiaryId', 'Int64')}
 
     def __init__(self, name="", code="", emailAddress="", parentAccountId=None, address=None, customFields=None, id=""):
         self.name = name
@@ -517,9 +1217,8 @@ class Account(M3terAPI):
             self.customFields = customFields
         url = root_api_url + self.class_url
         payload = json.dumps(self.__dict__)
-        response = executeAPI(action="POST", token=TOKEN, url=url, payload=payload)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Creating', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="POST", url=url, payload=payload)
+        self.invalidateIndex()
         return json.loads(response.text)
 
     def update(self, version=1, parentAccountId=None):
@@ -528,9 +1227,8 @@ class Account(M3terAPI):
         self.version = version
         url = root_api_url + self.class_url + "/" + self.id
         payload = json.dumps(self.__dict__)
-        response = executeAPI(action="PUT", token=TOKEN, url=url, payload=payload)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Updating', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="PUT", url=url, payload=payload)
+        self.invalidateIndex()
         return json.loads(response.text)
 
 
@@ -580,28 +1278,218 @@ class Commitment(M3terAPI):
         self.id = id
 
 
+def _encodeDefault(object):
+    if hasattr(object, 'todict'):
+        return object.todict()
+    raise TypeError(f'Object of type {object.__class__.__name__} is not JSON serializable')
+
+
+def dumps(object):
+    # Compact JSON as bytes, using orjson when it is installed
+    if orjson is not None:
+        return orjson.dumps(object, default=_encodeDefault)
+    return json.dumps(object, separators=(',', ':'), default=_encodeDefault).encode()
+
+
+def hasUid(measurement):
+    # m3ter ingests a measurement uid only once, so measurements that all carry one can be resent without duplicates.
+    # Already encoded measurements are never taken to have one; see MeasurementColumns.hasUids for columnar batches.
+    if isinstance(measurement, (bytes, bytearray)):
+        return False
+    if isinstance(measurement, dict):
+        return bool(measurement.get('uid'))
+    return bool(getattr(measurement, 'uid', None))
+
+
+def utcTimestamp():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
 class MeasurementData:
-    def __init__(self, meterCode="", accountCode="", timestamp=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+    # Slotted so millions of measurements can be held without a per-instance __dict__. Optional fields left as None
+    # are omitted from todict(). The default timestamp is taken when the measurement is created.
+    __slots__ = ('meter', 'account', 'ts', 'ets', 'measure', 'who', 'where', 'what', 'metadata', 'uid')
+    optionalFields = ('ets', 'measure', 'who', 'where', 'what', 'metadata')
+
+    def __init__(self, meterCode="", accountCode="", timestamp=None,
                  ets=None, measure=None, who=None, where=None, what=None, metadata=None, id=""):
         self.meter = meterCode
         self.account = accountCode
-        self.ts = timestamp
-        if ets:
-            self.ets = ets
-        if measure:
-            self.measure = measure
-        if who:
-            self.who = who
-        if where:
-            self.where = where
-        if what:
-            self.what = what
-        if metadata:
-            self.metadata = metadata
+        self.ts = timestamp or utcTimestamp()
+        self.ets = ets or None
+        self.measure = measure or None
+        self.who = who or None
+        self.where = where or None
+        self.what = what or None
+        self.metadata = metadata or None
         self.uid = id
 
     def todict(self):
-        return self.__dict__
+        measurement = {'meter': self.meter, 'account': self.account, 'ts': self.ts}
+        for field in self.optionalFields:
+            value = getattr(self, field)
+            if value is not None:
+                measurement[field] = value
+        measurement['uid'] = self.uid
+        return measurement
+
+
+def _jsonColumn(values):
+    # Factorised JSON of a column: codes into the distinct encoded values, -1 where the value is not set (None, or
+    # for float columns anything not finite). Strings and floats are encoded once per distinct value, other value
+    # types one by one, so 1 and True are never folded together.
+    if isinstance(values, np.ndarray) and values.dtype.kind == 'f':
+        codes, uniques = pd.factorize(values)
+        finite = np.isfinite(uniques)
+        return np.where(np.append(finite, False)[codes], codes, -1), [repr(float(value)).encode() for value in uniques]
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    if pd.api.types.infer_dtype(column, skipna=True) == 'string':
+        codes, uniques = pd.factorize(column)
+        return codes, [dumps(value) for value in uniques]
+    codes = np.arange(len(column))
+    codes[pd.isna(column)] = -1
+    return codes, [dumps(value) if code >= 0 else b'' for value, code in zip(column, codes)]
+
+
+def _jsonPiece(codes, encoded, prefix, suffix=b''):
+    # Object array of prefix + JSON + suffix per row, b'' where the value is not set
+    table = np.array([prefix + value + suffix for value in encoded] + [b''], dtype=object)
+    return table[codes]
+
+
+# Ingest request body: {"measurements":[ + comma separated measurements + ]}
+BATCH_PREFIX = b'{"measurements":['
+BATCH_SUFFIX = b']}'
+
+
+class MeasurementColumns:
+    # Columnar batch of measurements: one list per top-level field, and for measure / who / where / what / metadata
+    # one column per field code. Numeric measure columns are kept in float arrays and NaN (or any value that is not
+    # finite, which JSON cannot carry) means "not set" for that row. Iterating yields ingest-ready dicts; encoded() yields them already serialised, building the JSON column by
+    # column with numpy instead of a dict and a dumps call per row.
+    groups = ('measure', 'who', 'where', 'what', 'metadata')
+
+    def __init__(self, meter=None, account=None, ts=None, ets=None, uid=None, measure=None, who=None, where=None,
+                 what=None, metadata=None):
+        self.meter = list(meter) if meter is not None else []
+        self.account = list(account) if account is not None else []
+        self.ts = list(ts) if ts is not None else []
+        self.ets = list(ets) if ets is not None else None
+        self.uid = list(uid) if uid is not None else None
+        self.measure = {code: self.floatArray(values) for code, values in (measure or {}).items()}
+        self.who = {code: list(values) for code, values in (who or {}).items()}
+        self.where = {code: list(values) for code, values in (where or {}).items()}
+        self.what = {code: list(values) for code, values in (what or {}).items()}
+        self.metadata = {code: list(values) for code, values in (metadata or {}).items()}
+
+    @staticmethod
+    def floatArray(values):
+        # None is "not set", like in append(), and is stored as NaN
+        if hasattr(values, 'astype') and hasattr(values, 'tobytes'):
+            column = array('d')
+            column.frombytes(values.astype('float64').tobytes())
+            return column
+        return array('d', (math.nan if value is None else value for value in values))
+
+    def __len__(self):
+        return len(self.meter)
+
+    def hasUids(self):
+        # Per row whether the measurement carries a uid, in the order encoded() yields them
+        if self.uid is None:
+            return [False] * len(self.meter)
+        return [bool(uid) for uid in self.uid]
+
+    def append(self, measurement):
+        if isinstance(measurement, MeasurementData):
+            measurement = measurement.todict()
+        row = len(self.meter)
+        self.meter.append(measurement.get('meter', ''))
+        self.account.append(measurement.get('account', ''))
+        self.ts.append(measurement.get('ts') or utcTimestamp())
+        for field in ('ets', 'uid'):
+            if measurement.get(field) is not None and getattr(self, field) is None:
+                setattr(self, field, [None] * row)
+            if getattr(self, field) is not None:
+                getattr(self, field).append(measurement.get(field))
+        for group in self.groups:
+            columns = getattr(self, group)
+            values = measurement.get(group) or {}
+            for code in values:
+                if code not in columns:
+                    columns[code] = array('d', [math.nan] * row) if group == 'measure' else [None] * row
+            for code, column in columns.items():
+                value = values.get(code)
+                column.append(float(value) if group == 'measure' and value is not None else
+                              math.nan if group == 'measure' else value)
+        return self
+
+    def __iter__(self):
+        groups = [(group, list(getattr(self, group).items())) for group in self.groups if getattr(self, group)]
+        for row in range(len(self.meter)):
+            measurement = {'meter': self.meter[row], 'account': self.account[row], 'ts': self.ts[row]}
+            if self.ets is not None and self.ets[row] is not None:
+                measurement['ets'] = self.ets[row]
+            for group, columns in groups:
+                values = {}
+                for code, column in columns:
+                    value = column[row]
+                    if value is not None and value == value and (group != 'measure' or math.isfinite(value)):
+                        values[code] = value
+                if values:
+                    measurement[group] = values
+            if self.uid is not None and self.uid[row] is not None:
+                measurement['uid'] = self.uid[row]
+            yield measurement
+
+    def encoded(self, sliceSize=50000):
+        # Same measurements as iterating, as JSON bytes, built sliceSize rows at a time without a dict or a dumps call
+        # per row: each column is factorised and its distinct values encoded once together with their key, then a
+        # row is one join of its columns' pieces. Measure values that are not finite are left out, like NaN.
+        for start in range(0, len(self.meter), sliceSize):
+            yield from map(b''.join, zip(*self._pieces(start, min(start + sliceSize, len(self.meter)))))
+
+    def _pieces(self, start, end):
+        pieces = []
+        for field in ('meter', 'account', 'ts'):
+            codes, encoded = _jsonColumn(getattr(self, field)[start:end])
+            prefix = b'{"' if field == 'meter' else b',"'
+            pieces.append(_jsonPiece(np.where(codes >= 0, codes, len(encoded)), encoded + [b'null'],
+                                     prefix + field.encode() + b'":'))
+        if self.ets is not None:
+            pieces.append(_jsonPiece(*_jsonColumn(self.ets[start:end]), b',"ets":'))
+        for group in self.groups:
+            columns = getattr(self, group)
+            if not columns:
+                continue
+            started = np.zeros(end - start, dtype=bool)
+            for code, column in columns.items():
+                if group == 'measure' and isinstance(column, array):
+                    column = np.frombuffer(column, dtype='float64')
+                elif group == 'measure':
+                    column = np.asarray(column, dtype='float64')
+                codes, encoded = _jsonColumn(column[start:end])
+                key = dumps(code) + b':'
+                pieces.append(np.where(started, _jsonPiece(codes, encoded, b',' + key),
+                                       _jsonPiece(codes, encoded, b',"' + group.encode() + b'":{' + key)))
+                started |= codes >= 0
+            pieces.append(np.where(started, b'}', b'').astype(object))
+        if self.uid is not None:
+            pieces.append(_jsonPiece(*_jsonColumn(self.uid[start:end]), b',"uid":'))
+        pieces.append(np.full(end - start, b'}', dtype=object))
+        return pieces
+
+    def payloads(self, batchSize=1000):
+        # Complete ingest request bodies of up to batchSize measurements each
+        batch = []
+        for encoded in self.encoded():
+            batch.append(encoded)
+            if len(batch) >= batchSize:
+                yield BATCH_PREFIX + b','.join(batch) + BATCH_SUFFIX
+                batch = []
+        if batch:
+            yield BATCH_PREFIX + b','.join(batch) + BATCH_SUFFIX
 
 
 class Measure(M3terAPI):
@@ -614,23 +1502,38 @@ class Measure(M3terAPI):
     def send(self, measurementData):
         self.measurements = measurementData
         url = ingest_api_url + self.class_url
-        payload = json.dumps(self.__dict__)
-        response = executeAPI(action="POST", token=TOKEN, url=url, payload=payload)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Sending', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        payload = dumps(self.__dict__)
+        response = executeAPI(action="POST", url=url, payload=payload,
+                              idempotent=all(hasUid(measurement) for measurement in measurementData))
         return json.loads(response.text)
 
-    def getMeasureForAgg(self, aggregationId, startDate, endDate, accountCode):
+    def ingest(self, measurements, **options):
+        # Batched, concurrent send of MeasurementColumns or any iterable of MeasurementData / dicts / MeasurementColumns,
+        # see IngestPipeline for the options
+        return IngestPipeline(**options).run(measurements)
+
+    def ingestFrom(self, source, mapping, constants=None, chunkSize=100000, parseTimestamps=True, **options):
+        # Bulk load a DataFrame / CSV / Parquet file through readMeasurements and ingest it
+        chunks = readMeasurements(source, mapping, constants=constants, chunkSize=chunkSize,
+                                  parseTimestamps=parseTimestamps)
+        return self.ingest(chunks, **options)
+
+    def getMeasureForAgg(self, aggregationId, startDate, endDate, accountCode, policy=None):
+        # A range that keeps timing out (504) raises M3terAPIError instead of returning no values
         url = root_api_url + self.class_url + "/aggregations/" + aggregationId + "?startDate=" + startDate + "&endDate=" + endDate + "&accountCode=" + accountCode
-        payload = None
-        response = executeAPI(action="GET", token=TOKEN, url=url, payload=payload)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Retrieving', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
-        if response.status_code == 504:
-            print('Request timed out because of too much data.')
-            return json.loads('{"values":[]}')
-        else:
-            return json.loads(response.text)
+        response = executeAPI(action="GET", url=url, policy=policy)
+        return json.loads(response.text)
+
+    def getMeasureForAggFrame(self, aggregationId, startDate, endDate, accountCodes, shardDays=7, maxWorkers=8):
+        # Sharded getMeasureForAgg: one shard per account and shardDays of the range, run concurrently, halving
+        # any shard that times out; returns the values of all shards as one DataFrame with an accountCode column
+        def fetch(shard):
+            values = self.getMeasureForAgg(aggregationId, formatTimestamp(shard.start), formatTimestamp(shard.end),
+                                           shard.accounts[0], policy=shardPolicy).get('values', [])
+            return [dict(value, accountCode=shard.accounts[0]) for value in values]
+
+        planner = QueryPlanner(shardDays=shardDays, accountsPerShard=1, maxWorkers=maxWorkers)
+        return planner.run(startDate, endDate, accountCodes, fetch)
 
     def build(self, measurementData):
         self.measurements.append(measurementData)
@@ -640,6 +1543,253 @@ class Measure(M3terAPI):
         return self.__dict__
 
 
+# Bulk loading - converts whole columns of a DataFrame (or CSV / Parquet file, read in chunks) into MeasurementColumns
+# without building a Python object per row. mapping names the source column for each ingest field, e.g.
+#     {'meter': 'meter_code', 'account': 'account_code', 'ts': 'event_time', 'uid': 'event_id',
+#      'measure': {'calls': 'api_calls'}, 'who': {'user': 'user_id'}}
+# and constants gives fixed values for fields that are not in the file, e.g. {'meter': 'api_calls'}.
+def _objectColumn(series):
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def measurementsFromFrame(df, mapping, constants=None, parseTimestamps=True):
+    constants = constants or {}
+    rows = len(df)
+
+    def scalarColumn(field, required=True):
+        if field in mapping:
+            return _objectColumn(df[mapping[field]])
+        if field in constants:
+            return [constants[field]] * rows
+        if required:
+            raise KeyError(f'No column or constant given for measurement field: {field}')
+        return None
+
+    ts = scalarColumn('ts', required=False)
+    if 'ts' in mapping and parseTimestamps:
+        ts = pd.to_datetime(df[mapping['ts']], utc=True).dt.strftime('%Y-%m-%dT%H:%M:%SZ').tolist()
+    elif ts is None:
+        ts = [utcTimestamp()] * rows
+    ets = scalarColumn('ets', required=False)
+    if ets is not None and 'ets' in mapping and parseTimestamps:
+        ets = pd.to_datetime(df[mapping['ets']], utc=True).dt.strftime('%Y-%m-%dT%H:%M:%SZ').tolist()
+
+    groups = {}
+    for group in MeasurementColumns.groups:
+        columns = mapping.get(group) or {}
+        if group == 'measure':
+            groups[group] = {code: pd.to_numeric(df[column], errors='coerce').to_numpy(dtype='float64')
+                             for code, column in columns.items()}
+        else:
+            groups[group] = {code: _objectColumn(df[column]) for code, column in columns.items()}
+
+    return MeasurementColumns(meter=scalarColumn('meter'), account=scalarColumn('account'), ts=ts, ets=ets,
+                              uid=scalarColumn('uid', required=False), **groups)
+
+
+def readMeasurements(source, mapping, constants=None, chunkSize=100000, parseTimestamps=True, **readOptions):
+    # Yields MeasurementColumns of up to chunkSize rows from a DataFrame, a .csv(.gz) file or a .parquet file
+    columns = [column for value in mapping.values()
+               for column in (value.values() if isinstance(value, dict) else [value])]
+    if isinstance(source, pd.DataFrame):
+        frames = (source.iloc[start:start + chunkSize] for start in range(0, len(source), chunkSize))
+    elif str(source).endswith('.parquet'):
+        import pyarrow.parquet as pq
+        frames = (batch.to_pandas() for batch in
+                  pq.ParquetFile(source).iter_batches(batch_size=chunkSize, columns=columns))
+    else:
+        frames = pd.read_csv(source, usecols=columns, chunksize=chunkSize, **readOptions)
+    for frame in frames:
+        yield measurementsFromFrame(frame, mapping, constants=constants, parseTimestamps=parseTimestamps)
+
+
+BatchResult = namedtuple('BatchResult', ['index', 'count', 'bytes', 'status', 'attempts', 'seconds', 'error'])
+
+
+class IngestPipeline:
+    # Splits a stream of measurements into ingest requests of at most batchSize measurements and maxBytes of JSON,
+    # and posts them from maxWorkers threads. Only maxInFlight batches are built ahead of the senders, so a slow API
+    # throttles reading the input instead of letting it pile up in memory. Transient errors are already retried
+    # inside executeAPI; a batch that still fails is resent up to maxAttempts times before it is reported as failed.
+    # Only batches whose measurements all have a uid are resent after a 5xx or timeout, any other batch only when it
+    # was throttled, as it may already have been ingested.
+    def __init__(self, batchSize=1000, maxBytes=512 * 1024, maxWorkers=8, maxInFlight=None, maxAttempts=3,
+                 onResult=None):
+        self.batchSize = batchSize
+        self.maxBytes = maxBytes
+        self.maxWorkers = maxWorkers
+        self.maxInFlight = maxInFlight or maxWorkers * 2
+        self.maxAttempts = maxAttempts
+        self.onResult = onResult
+        self.url = ingest_api_url + Measure.class_url
+
+    @staticmethod
+    def encoded(measurements):
+        # (JSON, has a uid) per measurement. Whether it has a uid is taken from the measurement before it is encoded;
+        # MeasurementColumns (also as items of the iterable, e.g. readMeasurements chunks) are encoded column-wise
+        if isinstance(measurements, MeasurementColumns):
+            measurements = [measurements]
+        for measurement in measurements:
+            if isinstance(measurement, MeasurementColumns):
+                yield from zip(measurement.encoded(), measurement.hasUids())
+            elif isinstance(measurement, (bytes, bytearray)):
+                yield measurement, False
+            else:
+                yield dumps(measurement), hasUid(measurement)
+
+    def batches(self, measurements):
+        # Yields (encoded measurements, all have a uid) per batch; size is the exact payload size send() will post,
+        # the {"measurements":[...]} wrapper and the commas between measurements included
+        batch = []
+        idempotent = True
+        size = len(BATCH_PREFIX) + len(BATCH_SUFFIX)
+        for encoded, uid in self.encoded(measurements):
+            if batch and (len(batch) >= self.batchSize or size + len(encoded) + 1 > self.maxBytes):
+                yield batch, idempotent
+                batch = []
+                idempotent = True
+                size = len(BATCH_PREFIX) + len(BATCH_SUFFIX)
+            size += len(encoded) + (1 if batch else 0)
+            batch.append(encoded)
+            idempotent = idempotent and uid
+        if batch:
+            yield batch, idempotent
+
+    def send(self, index, batch, idempotent=False):
+        payload = BATCH_PREFIX + b','.join(batch) + BATCH_SUFFIX
+        start = time.perf_counter()
+        error = None
+        status = None
+        for attempt in range(1, self.maxAttempts + 1):
+            try:
+                response = executeAPI(action="POST", url=self.url, payload=payload, idempotent=idempotent)
+                status = response.status_code
+                error = None if 200 <= status < 300 else response.text
+                break
+            except M3terAPIError as failure:
+                status = failure.status
+                error = str(failure)
+                if not idempotent and status != 429:
+                    break
+                if attempt < self.maxAttempts:
+                    time.sleep(executor.policy.delay(attempt))
+        return BatchResult(index, len(batch), len(payload), status, attempt, time.perf_counter() - start, error)
+
+    def run(self, measurements):
+        results = []
+        sent = 0
+
+        def collect(done):
+            nonlocal sent
+            for future in done:
+                result = future.result()
+                results.append(result)
+                sent += result.count if result.error is None else 0
+                if self.onResult:
+                    self.onResult(result)
+
+        with ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix='ingest') as pool:
+            pending = set()
+            for index, (batch, idempotent) in enumerate(self.batches(measurements)):
+                if len(pending) >= self.maxInFlight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(pool.submit(self.send, index, batch, idempotent))
+            collect(pending)
+
+        results.sort(key=lambda result: result.index)
+        failed = [result for result in results if result.error is not None]
+        printme(f'Ingested {sent} measurement(s) in {len(results)} batch(es), {len(failed)} failed',
+                color='red' if failed else 'green', dots=True)
+        return results
+
+
+# Query planning for the data explorer and aggregation endpoints - large date ranges / account sets are split into
+# time x account shards that run concurrently. A shard that times out is split in half and both halves are queued
+# again: its time range while that is longer than a day, then its accounts, then the time range down to minShard.
+Shard = namedtuple('Shard', ['start', 'end', 'accounts'])
+
+# Shards are not retried on timeouts (a 504 or the client giving up) - splitting them is cheaper than asking for the
+# same range again
+shardPolicy = RetryPolicy(maxAttempts=3, retryStatuses=(429, 500, 502, 503), failStatuses=(504,), retryTimeouts=False)
+
+
+def parseTimestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day, tzinfo=datetime.timezone.utc)
+    parsed = datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+def formatTimestamp(value):
+    return value.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def isTimeout(error):
+    return isinstance(error, requests.Timeout) or (isinstance(error, M3terAPIError) and
+                                                   (error.timeout or error.status == 504))
+
+
+class QueryPlanner:
+    def __init__(self, shardDays=7, accountsPerShard=50, maxWorkers=8, minShard=datetime.timedelta(hours=1)):
+        self.shardDays = shardDays
+        self.accountsPerShard = accountsPerShard
+        self.maxWorkers = maxWorkers
+        self.minShard = minShard
+
+    def plan(self, startDate, endDate, accounts=None):
+        start, end = parseTimestamp(startDate), parseTimestamp(endDate)
+        step = datetime.timedelta(days=self.shardDays)
+        accountGroups = [None] if accounts is None else \
+            [tuple(accounts[i:i + self.accountsPerShard]) for i in range(0, len(accounts), self.accountsPerShard)]
+        shards = []
+        while start < end:
+            shardEnd = min(start + step, end)
+            shards.extend(Shard(start, shardEnd, group) for group in accountGroups)
+            start = shardEnd
+        return shards
+
+    def split(self, shard):
+        span = shard.end - shard.start
+        splitAccounts = shard.accounts is not None and len(shard.accounts) > 1
+        if span > self.minShard and (span > datetime.timedelta(days=1) or not splitAccounts):
+            middle = shard.start + span / 2
+            return [Shard(shard.start, middle, shard.accounts), Shard(middle, shard.end, shard.accounts)]
+        if splitAccounts:
+            half = len(shard.accounts) // 2
+            return [Shard(shard.start, shard.end, shard.accounts[:half]),
+                    Shard(shard.start, shard.end, shard.accounts[half:])]
+        return None
+
+    def run(self, startDate, endDate, accounts, fetch):
+        # fetch(shard) returns a list of row dicts; rows of all shards are returned as one DataFrame
+        accounts = list(accounts) if accounts is not None else None
+        rows = []
+        splits = 0
+        with ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix='query') as pool:
+            pending = {pool.submit(fetch, shard): shard for shard in self.plan(startDate, endDate, accounts)}
+            shards = len(pending)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    shard = pending.pop(future)
+                    try:
+                        rows.extend(future.result())
+                    except Exception as error:
+                        halves = self.split(shard) if isTimeout(error) else None
+                        if halves is None:
+                            raise
+                        splits += 1
+                        shards += len(halves)
+                        for half in halves:
+                            pending[pool.submit(fetch, half)] = half
+        printme(f'Query ran {shards} shard(s), {splits} split after timing out, {len(rows)} row(s)', color='yellow',
+                dots=True)
+        return pd.DataFrame.from_records(rows)
+
+
 class LineItem(M3terAPI):
     class_url = "/bills"
 
@@ -649,17 +1799,29 @@ class LineItem(M3terAPI):
 
 class Bill(M3terAPI):
     class_url = "/bills"
+    frameSchema = {'billId': ('id', 'object'), 'version': ('version', 'Int64'), 'accountId': ('accountId', 'object'),
+                   'accountCode': ('accountCode', 'object'), 'billDate': ('billDate', 'datetime64[ns, UTC]'),
+                   'status': ('status', 'category'), 'currency': ('currency', 'category'), 'locked': ('locked', 'bool'),
+                   'lastCalculatedDate': ('lastCalculatedDate', 'datetime64[ns, UTC]')}
 
     def __init__(self, id=""):
         self.id = id
 
+    def loadForBillDate(self, billDate, endDate=None, pageSize=200, prefetch=False):
+        # Streams the bills with billDate in [billDate, endDate) one page at a time. The date window is applied
+        # server side so only the wanted bills are downloaded. endDate defaults to the day after billDate.
+        if isinstance(billDate, str):
+            billDate = datetime.date.fromisoformat(billDate)
+        if endDate is None:
+            endDate = billDate + datetime.timedelta(days=1)
+        elif isinstance(endDate, str):
+            endDate = datetime.date.fromisoformat(endDate)
+        params = {'billDateStart': billDate.isoformat(), 'billDateEnd': endDate.isoformat(), 'pageSize': pageSize}
+        return self.iterPages(params=params, prefetch=prefetch)
+
     def getAccountBill(self, accountId):
         url = root_api_url + self.class_url + "/accountid/" + accountId
-        print(url)
-        payload = None
-        response = executeAPI(action="GET", token=TOKEN, url=url, payload=payload)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Retrieving', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="GET", url=url)
         result = json.loads(response.text)['data']
         # print(result)
         return result
@@ -727,10 +1889,7 @@ class OrganizationConfig(M3terAPI):
 
     def get(self):
         url = root_api_url + self.class_url
-        payload = None
-        response = executeAPI(action="GET", token=TOKEN, url=url, payload="")
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Getting', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="GET", url=url, payload="")
         return json.loads(response.text)
 
 
@@ -740,10 +1899,21 @@ class UsageData(M3terAPI):
     def __init__(self, id=None):
         self.id = id
 
-    def query(self, query):
+    def query(self, query, policy=None):
         url = root_api_url + self.class_url
         payload = json.dumps(query)
-        response = executeAPI(action="POST", token=TOKEN, url=url, payload=payload)
-        if LOGGING: logger.debug(logfile=logfile, entity=self.class_url[1:-1], action='Creating', payload=payload,
-                             status=response.status_code, response=response.text, url=url)
+        response = executeAPI(action="POST", url=url, payload=payload, policy=policy, idempotent=True)
         return json.loads(response.text)
+
+    def queryFrame(self, query, shardDays=7, accountsPerShard=50, maxWorkers=8):
+        # Sharded query: the startDate/endDate range and the accountIds list (when given) are split into shards that
+        # run concurrently, any shard that times out is halved and retried, and the rows are merged into one frame
+        def fetch(shard):
+            shardQuery = dict(query, startDate=formatTimestamp(shard.start), endDate=formatTimestamp(shard.end))
+            if shard.accounts is not None:
+                shardQuery['accountIds'] = list(shard.accounts)
+            result = self.query(shardQuery, policy=shardPolicy)
+            return result.get('data', []) if isinstance(result, dict) else result
+
+        planner = QueryPlanner(shardDays=shardDays, accountsPerShard=accountsPerShard, maxWorkers=maxWorkers)
+        return planner.run(query['startDate'], query['endDate'], query.get('accountIds'), fetch)
@@ -2,25 +2,37 @@
 # Schedule: Every month on 27th and again at the last day of that month for the remainder of the days in that month
 # Extracts billing info (Subsidiary Id, SF Account Id, Netsuite Product Code, Quantity, Price and Date)
 # Output: csv
+# Catch-up for a range of bill dates in one run: python main.py --from 2022-11-27 --to 2022-11-30
 
 import logging
 import sys
 import json
-import boto3
 import os
-from io import StringIO
 from datetime import datetime, timedelta
 import m3terSDK as m3ter
+from instrumentation import RunReport
+from exportSinks import exportPath, writeFrame
 import pandas as pd
-from sqlalchemy import create_engine
-import re
-
-# Setup Logging
+from sqlalchemy import select, table, column, func, cast, literal, String
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+import time
+import sqlite3
+import argparse
+import hashlib
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import pyarrow
+except ImportError:  # optional - xref snapshots are kept as sqlite files instead of Parquet
+    pyarrow = None
+
+# Setup Logging - LOG_LEVEL=DEBUG adds one structured line per m3ter API request (see m3terSDK.RequestLog)
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
 
 handler = logging.StreamHandler(sys.stdout)
-handler.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
@@ -30,110 +42,739 @@ logger.addHandler(handler)
 
 # The utility runs on AWS lambda (use main() for manual runs)
 # AWS config is in serverless.yml - for more details, reach out to Dávid K or Jamie C
-# s3_resource = boto3.resource('s3')
-# bucket = os.getenv('S3_BUCKET')
-
-
-# Functions for logs - local CSV or S3_bucket on AWS
-def df_to_s3(df, filename):
-    # if bucket:
-    #   csv_buffer = StringIO()
-    #  df.to_csv(csv_buffer)
-    # s3_resource.Object(bucket, filename).put(Body=csv_buffer.getvalue())
-    # else:
-    # logger.debug('S3_BUCKET not set. Running locally.')
-    df.to_csv(f"logs/{filename}", mode="w", index=False)
-
-
-
 
-def main():
-    m3ter.printme('Starting execution ', time=True, color='red', dots=True)
 
-    # read from onfido aurora database to find netsuite product ids and netsuite bundle id
-    connection = m3ter.openSqlAlchemy()
-    currentSchema = os.environ['currentSchemaName']
-    productData_df = pd.read_sql_table(table_name='input_activeproducts', con=connection, schema=currentSchema)
-    bundleData_df = pd.read_sql_table(table_name='bill_netsuite_xref', con=connection, schema=currentSchema)
-
-    bills = m3ter.Bill().load()
-
-    bills_df = pd.json_normalize(bills, record_path='lineItems',
-                                 meta=['id', 'version', 'accountId', 'accountCode',
-                                       'startDate', 'endDate', 'startDateTimeUTC',
-                                       'endDateTimeUTC', 'billDate', 'dueDate',
-                                       'billingFrequency', 'billFrequencyInterval',
-                                       'timezone', 'currency', 'locked', 'createdDate',
-                                       'status', 'billJobId', 'lastCalculatedDate'],
-                                 errors='ignore', record_prefix='lineItems-')
-
-    # BilDate == yesterday
-    yday = str((datetime.today() - timedelta(days=1)))
-    yday = yday.split(" ")[0]
-    bills_df = bills_df.loc[bills_df.billDate == yday]
-
-    pricingBand_df = pd.json_normalize(bills, ['lineItems', 'usagePerPricingBand'],
-                                       record_prefix='lineItems-usagePerPricingBand-')
-    bills_df['lineItems-usagePerPricingBand-unitPrice'] = pricingBand_df['lineItems-usagePerPricingBand-unitPrice']
-
-    bills_df_columns = bills_df[
-        ['id', 'accountId', 'accountCode', 'lineItems-productId', 'lineItems-quantity', 'lineItems-productName',
-         'lastCalculatedDate', 'lineItems-usagePerPricingBand', 'lineItems-description', 'lineItems-meterId',
-         'lineItems-usagePerPricingBand-unitPrice', 'lineItems-planId']]
-
-    # Reformat lastCalculatedDate and UnitPrice
-    bills_df_columns['lastCalculatedDate'] = pd.to_datetime(bills_df_columns['lastCalculatedDate']).dt.strftime('%d/%m/20%y')
-    bills_df_columns = bills_df_columns.round(2)
-
-    account = m3ter.Account().load()
-    account_df = pd.json_normalize(account)
-    account_df_columns = account_df[['id', 'customFields.subsidiaryId']]
-
-    meter = m3ter.Meter().load()
-    meter_df = pd.json_normalize(meter)
-    meter_df.columns = meter_df.columns.str.replace('id', 'meterId')
-    meter_df.columns = meter_df.columns.str.replace('code', 'meter-code')
-
-    plan = m3ter.Plan().load()
-    plan_df = pd.json_normalize(plan)
-    plan_df.columns = plan_df.columns.str.replace('id', 'planId')
-
-    # merge all tables
-    dataExfiltration = bills_df_columns.merge(account_df_columns, how='left', left_on='accountId', right_on='id')
-    dataExfiltration = dataExfiltration.merge(plan_df, how='left', left_on='lineItems-planId', right_on='planId')
-    dataExfiltration = dataExfiltration.merge(meter_df, how='left', left_on='lineItems-meterId', right_on='meterId')
-    dataExfiltration = dataExfiltration.merge(productData_df, how='left', left_on='meter-code', right_on='Meter_Code__c')
-    dataExfiltration = dataExfiltration.merge(bundleData_df, how='left', left_on='code', right_on='opportunityId')
-
-    # NC Addition ------------------------
-    dataExfiltration['Netsuite_Product_Id__c'] = dataExfiltration['Netsuite_Product_Id__c'].fillna("0")
-    dataExfiltration['Netsuite_Product_Id__c'] = dataExfiltration['Netsuite_Product_Id__c'].astype(int)
-
-    df_to_s3(dataExfiltration, 'lineItems.csv')
+# Exports - local files or S3 on AWS. EXPORT_TARGET is a directory or an s3://bucket/prefix (S3_BUCKET on its own means
+# s3://<bucket>, S3_ENDPOINT_URL points at an S3 compatible store). Written as EXPORT_FORMAT (csv or parquet), CSV
+# optionally EXPORT_COMPRESSION (gzip or zstd), EXPORT_CHUNK_ROWS rows at a time.
+def exportTarget():
+    if os.getenv('EXPORT_TARGET'):
+        return os.getenv('EXPORT_TARGET')
+    if os.getenv('S3_BUCKET'):
+        return 's3://' + os.getenv('S3_BUCKET')
+    return 'logs'
+
+
+def exportFrame(df, name, base=None):
+    format = os.getenv('EXPORT_FORMAT', 'csv')
+    compression = os.getenv('EXPORT_COMPRESSION') or None
+    target = exportPath(base or exportTarget(), name, format, compression)
+    writeFrame(df, target, format, compression, chunkSize=int(os.getenv('EXPORT_CHUNK_ROWS', '100000')))
+    return target
+
+
+# Fetch stage - the DB tables and m3ter collections are independent, so they are read concurrently and the
+# stage takes as long as the slowest source rather than the sum of all of them
+def timedFetch(name, fetch, report=None):
+    # A fetch that consumes its rows itself may return their count instead
+    start = time.perf_counter()
+    with report.stage('fetch ' + name) if report is not None else nullcontext() as stage:
+        result = fetch()
+        size = result if isinstance(result, int) else len(result) if hasattr(result, '__len__') else 0
+        if stage is not None:
+            stage.rowsOut = size
+    elapsed = time.perf_counter() - start
+    m3ter.printme(f'Fetched {name}: {size} rows in {elapsed:.2f}s', color='cyan', dots=True)
+    return result, elapsed
+
+
+def fetchSources(sources, maxWorkers=None, report=None):
+    # sources is a dict of name -> zero-argument callable; returns (results, timings) keyed by the same names. With a
+    # RunReport each source is also recorded as a 'fetch <name>' stage
+    if len(sources) > m3ter.transport.poolSize:
+        m3ter.configureTransport(poolSize=len(sources))
+    with ThreadPoolExecutor(max_workers=maxWorkers or len(sources), thread_name_prefix='fetch') as pool:
+        futures = {name: pool.submit(timedFetch, name, fetch, report) for name, fetch in sources.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    return {name: result[0] for name, result in results.items()}, {name: result[1] for name, result in results.items()}
+
+
+# Reference data reads - select only the columns the export uses and only the rows whose key is in the current
+# bill set, with the keys sent in batches of IN lists, and stream the result in chunks from a server side cursor.
+# Rows come back ordered by key (then the other columns), so the first row of a duplicated key is the same every run.
+PRODUCT_COLUMNS = ['Meter_Code__c', 'Netsuite_Product_Id__c']
+BUNDLE_COLUMNS = ['opportunityId', 'netsuiteId']
+
+
+def iterReference(connection, schema, tableName, columns, keyColumn, keys, batchSize=1000, chunkSize=50000):
+    # keys=None reads every row of the projected columns
+    source = table(tableName, *[column(name) for name in columns], schema=schema)
+    order = ([keyColumn] if keyColumn else []) + [name for name in columns if name != keyColumn]
+    if keys is None:
+        batches = [None]
+    else:
+        keys = sorted({key for key in keys if isinstance(key, str) and key})
+        batches = [keys[start:start + batchSize] for start in range(0, len(keys), batchSize)]
+    with connection.connect().execution_options(stream_results=True) as stream:
+        for batch in batches:
+            query = select(*[source.c[name] for name in columns]).order_by(*[source.c[name] for name in order])
+            if batch is not None:
+                query = query.where(source.c[keyColumn].in_(batch))
+            yield from pd.read_sql(query, stream, chunksize=chunkSize)
+
+
+def readReference(connection, schema, tableName, columns, keyColumn, keys, batchSize=1000, chunkSize=50000):
+    frames = list(iterReference(connection, schema, tableName, columns, keyColumn, keys, batchSize, chunkSize))
+    if not frames:
+        return pd.DataFrame({name: pd.Series(dtype='object') for name in columns})
+    return pd.concat(frames, ignore_index=True)
+
+
+# Xref snapshots - local, versioned copies of the projected cross-reference tables. Within ttl seconds of the last
+# check a snapshot is used without opening a database connection; after that a content version of the projected
+# columns decides whether the table is read again. On Postgres that is an md5 over every row computed server side, so
+# only one value crosses the wire; other databases return the rows and they are hashed here. A changedColumn that
+# the table reliably maintains (an updated-at timestamp) replaces the hash with a cheaper count + max(changedColumn),
+# which misses in-place updates that do not touch it. Snapshots are Parquet files read memory-mapped when
+# pyarrow is installed, sqlite files otherwise. Every version gets its own file, so a reader never sees a partial
+# write, and the engine is only created when a check or refresh actually needs it.
+class ReferenceSnapshot:
+    def __init__(self, path, openEngine, schema, ttl=3600, changedColumn=None):
+        self.path = path
+        self.openEngine = openEngine
+        self.schema = schema
+        self.ttl = ttl
+        self.changedColumn = changedColumn
+        self._engine = None
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.manifest = os.path.join(self.path, 'manifest.db')
+        with sqlite3.connect(self.manifest) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, version TEXT, '
+                               'checked REAL, file TEXT)')
+
+    def engine(self):
+        with self._lock:
+            if self._engine is None:
+                self._engine = self.openEngine()
+            return self._engine
+
+    def version(self, tableName, columns):
+        # Version computed by the database, or None when it has to be computed from the rows (frameVersion)
+        source = table(tableName, *[column(name) for name in columns], schema=self.schema)
+        if self.changedColumn:
+            query = select(func.count(), func.max(column(self.changedColumn))).select_from(source)
+        elif self.engine().dialect.name == 'postgresql':
+            cells = [func.coalesce(cast(source.c[name], String), '\\N') for name in columns]
+            rowHash = func.md5(func.concat_ws('|', *cells))
+            query = select(func.count(), func.md5(func.string_agg(rowHash, aggregate_order_by(literal(','), rowHash))))
+        else:
+            return None
+        with self.engine().connect() as connection:
+            return '|'.join(str(value) for value in connection.execute(query).one())
+
+    @staticmethod
+    def frameVersion(frame):
+        rows = pd.util.hash_pandas_object(frame, index=False).to_numpy()
+        return f'{len(frame)}|' + hashlib.md5(rows.tobytes()).hexdigest()
+
+    def read(self, tableName, columns):
+        name = f'{self.schema}.{tableName}:' + ','.join(columns)
+        with sqlite3.connect(self.manifest) as connection:
+            row = connection.execute('SELECT version, checked, file FROM snapshots WHERE name = ?', (name,)).fetchone()
+        if row is not None and not os.path.exists(row[2]):
+            row = None
+        if row is not None and time.time() - row[1] < self.ttl:
+            return self.load(row[2], columns)
+
+        frame = None
+        version = self.version(tableName, columns)
+        if version is None:
+            frame = readReference(self.engine(), self.schema, tableName, columns, keyColumn=None, keys=None)
+            version = self.frameVersion(frame)
+        if row is not None and row[0] == version:
+            with sqlite3.connect(self.manifest) as connection:
+                connection.execute('UPDATE snapshots SET checked = ? WHERE name = ?', (time.time(), name))
+            return self.load(row[2], columns)
+
+        if frame is None:
+            frame = readReference(self.engine(), self.schema, tableName, columns, keyColumn=None, keys=None)
+        file = self.write(name, version, frame)
+        with sqlite3.connect(self.manifest) as connection:
+            connection.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)', (name, version, time.time(), file))
+        if row is not None and row[2] != file and os.path.exists(row[2]):
+            os.remove(row[2])
+        return frame
+
+    def write(self, name, version, frame):
+        stem = os.path.join(self.path, name.split(':')[0] + '-' + hashlib.sha1((name + version).encode()).hexdigest()[:12])
+        if pyarrow is not None:
+            file = stem + '.parquet'
+            frame.to_parquet(file + '.tmp', index=False)
+        else:
+            file = stem + '.sqlite'
+            if os.path.exists(file + '.tmp'):
+                os.remove(file + '.tmp')
+            with sqlite3.connect(file + '.tmp') as connection:
+                frame.to_sql('snapshot', connection, index=False)
+            connection.close()
+        os.replace(file + '.tmp', file)
+        return file
+
+    @staticmethod
+    def load(file, columns):
+        if file.endswith('.parquet'):
+            return pd.read_parquet(file, columns=columns, memory_map=True)
+        with sqlite3.connect(f'file:{file}?mode=ro', uri=True) as connection:
+            connection.execute('PRAGMA mmap_size = 268435456')
+            frame = pd.read_sql_query('SELECT ' + ', '.join(f'"{name}"' for name in columns) + ' FROM snapshot',
+                                      connection)
+        connection.close()
+        return frame
+
+
+# Incremental mode - remembers every exported bill's version and lastCalculatedDate plus a high-water mark, so
+# later runs only fetch the recent bill-date window and only export bills that are new or were recalculated
+class BillSyncState:
+    # Export state of the incremental runs: per bill the version and lastCalculatedDate last exported, per line item a
+    # hash of the fields the export reads, so a recalculated bill only re-exports the line items that changed
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(self.path) as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS bills (id TEXT PRIMARY KEY, version INTEGER, '
+                               'lastCalculatedDate TEXT, billDate TEXT)')
+            connection.execute('CREATE TABLE IF NOT EXISTS lineItems (id TEXT, lineItemIndex INTEGER, hash TEXT, '
+                               'PRIMARY KEY (id, lineItemIndex))')
+            connection.execute('CREATE TABLE IF NOT EXISTS watermark (key TEXT PRIMARY KEY, value TEXT)')
+
+    def highWaterMark(self):
+        with sqlite3.connect(self.path) as connection:
+            return dict(connection.execute('SELECT key, value FROM watermark').fetchall())
+
+    def begin(self, day):
+        # Sets the start of the sync on the first incremental run: bills dated before it that the state has never
+        # seen were exported by the daily runs before the switch, so they are only recorded, not exported again. A
+        # state from before the mark existed starts at its earliest recorded bill.
+        with sqlite3.connect(self.path) as connection:
+            earliest = connection.execute('SELECT MIN(billDate) FROM bills').fetchone()[0]
+            connection.execute('INSERT OR IGNORE INTO watermark VALUES (?, ?)',
+                               ('syncStart', earliest or day.isoformat()))
+
+    @staticmethod
+    def lineItemHash(lineItem):
+        fields = {field: lineItem.get(field) for field in LINE_ITEM_COLUMNS}
+        fields['bands'] = [{field: band.get(field) for field in PRICING_BAND_COLUMNS}
+                           for band in lineItem.get('usagePerPricingBand') or []]
+        return hashlib.md5(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def select(connection, query, ids, batchSize=500):
+        # Rows for the given bill ids only, in batches below sqlite's bound parameter limit
+        ids = list(ids)
+        for start in range(0, len(ids), batchSize):
+            batch = ids[start:start + batchSize]
+            yield from connection.execute(query.format(', '.join('?' * len(batch))), batch)
+
+    def changedBills(self, bills, seeded=None):
+        # Bills never exported before, or with a higher version / later lastCalculatedDate than when last exported.
+        # Their line items that were exported unchanged are replaced by None, so flattenBills skips them while the
+        # others keep their lineItemIndex. Unseen bills dated before the start of the sync go to seeded instead.
+        bills = list(bills)
+        with sqlite3.connect(self.path) as connection:
+            syncStart = connection.execute("SELECT value FROM watermark WHERE key = 'syncStart'").fetchone()
+            syncStart = syncStart[0] if syncStart else ''
+            seen = {row[0]: row[1:] for row in self.select(
+                connection, 'SELECT id, version, lastCalculatedDate FROM bills WHERE id IN ({})',
+                [bill['id'] for bill in bills])}
+            changed = []
+            for bill in bills:
+                previous = seen.get(bill['id'])
+                if previous is None and seeded is not None and (bill.get('billDate') or '') < syncStart:
+                    seeded.append(bill)
+                elif previous is None or (bill.get('version') or 0) > (previous[0] or 0) \
+                        or (bill.get('lastCalculatedDate') or '') > (previous[1] or ''):
+                    changed.append(bill)
+            hashes = {(row[0], row[1]): row[2] for row in self.select(
+                connection, 'SELECT id, lineItemIndex, hash FROM lineItems WHERE id IN ({})',
+                [bill['id'] for bill in changed if bill['id'] in seen])}
+        for position, bill in enumerate(changed):
+            if bill['id'] in seen:
+                lineItems = [None if hashes.get((bill['id'], index)) == self.lineItemHash(lineItem) else lineItem
+                             for index, lineItem in enumerate(bill.get('lineItems') or [])]
+                changed[position] = dict(bill, lineItems=lineItems)
+        return changed
+
+    def record(self, bills):
+        # Takes the bills returned by changedBills; line items left as None are already stored unchanged
+        if not bills:
+            return
+        with sqlite3.connect(self.path) as connection:
+            connection.executemany('INSERT OR REPLACE INTO bills VALUES (?, ?, ?, ?)',
+                                   [(bill['id'], bill.get('version'), bill.get('lastCalculatedDate'),
+                                     bill.get('billDate')) for bill in bills])
+            connection.executemany('DELETE FROM lineItems WHERE id = ? AND lineItemIndex >= ?',
+                                   [(bill['id'], len(bill.get('lineItems') or [])) for bill in bills])
+            connection.executemany('INSERT OR REPLACE INTO lineItems VALUES (?, ?, ?)',
+                                   [(bill['id'], index, self.lineItemHash(lineItem)) for bill in bills
+                                    for index, lineItem in enumerate(bill.get('lineItems') or [])
+                                    if lineItem is not None])
+            watermark = dict(connection.execute('SELECT key, value FROM watermark').fetchall())
+            for key in ['billDate', 'lastCalculatedDate', 'createdDate']:
+                latest = max([bill.get(key) or '' for bill in bills] + [watermark.get(key) or ''])
+                connection.execute('INSERT OR REPLACE INTO watermark VALUES (?, ?)', (key, latest))
+
+
+def billWindow(yday, state, lookbackDays):
+    # Daily runs only look at yesterday; incremental runs re-scan lookbackDays before the high-water mark (yesterday
+    # on the first run) because bills stay open to recalculation until they are locked
+    if state is None:
+        return yday, yday + timedelta(days=1)
+    watermark = state.highWaterMark().get('billDate')
+    start = min(datetime.fromisoformat(watermark[:10]).date(), yday) if watermark else yday
+    return start - timedelta(days=lookbackDays), yday + timedelta(days=1)
+
+
+# Bill flattening - walks the bills once and yields fixed-size, typed chunks of line items (with their bill's meta
+# fields) and of their pricing bands, keyed by bill id + lineItemIndex. Bills outside billDate are skipped before
+# any rows are built, so frames are only ever materialised for the bills that are exported. Line items that are None
+# (exported unchanged before, see BillSyncState.changedBills) are skipped too.
+BILL_META_COLUMNS = {'id': 'object', 'version': 'Int64', 'accountId': 'object', 'accountCode': 'object',
+                     'billDate': 'object', 'currency': 'category', 'status': 'category',
+                     'lastCalculatedDate': 'datetime64[ns, UTC]'}
+LINE_ITEM_COLUMNS = {'productId': 'object', 'productName': 'object', 'description': 'object', 'meterId': 'object',
+                     'planId': 'object', 'lineItemType': 'category', 'quantity': 'float64', 'subtotal': 'float64'}
+PRICING_BAND_COLUMNS = {'unitPrice': 'float64', 'bandQuantity': 'float64', 'bandSubtotal': 'float64',
+                        'lowerLimit': 'float64', 'fixedPrice': 'float64'}
+LINE_ITEM_PREFIX = 'lineItems-'
+PRICING_BAND_PREFIX = 'lineItems-usagePerPricingBand-'
+
+
+def typedFrame(columns, dtypes):
+    frame = {}
+    for name, values in columns.items():
+        dtype = dtypes[name]
+        if dtype.startswith('datetime64'):
+            frame[name] = pd.to_datetime(pd.Series(values, dtype='object'), utc=True, errors='coerce')
+        else:
+            frame[name] = pd.Series(values, dtype=dtype)
+    return pd.DataFrame(frame)
+
+
+LINE_ITEM_TYPES = dict({'lineItemIndex': 'int32'}, **BILL_META_COLUMNS,
+                       **{LINE_ITEM_PREFIX + field: dtype for field, dtype in LINE_ITEM_COLUMNS.items()})
+PRICING_BAND_TYPES = dict({'id': 'object', 'lineItemIndex': 'int32'},
+                          **{PRICING_BAND_PREFIX + field: dtype for field, dtype in PRICING_BAND_COLUMNS.items()})
+
+
+def emptyFrame(dtypes):
+    return typedFrame({name: [] for name in dtypes}, dtypes)
+
+
+def flattenBills(bills, billDate=None, chunkSize=100000):
+    lineItemTypes = LINE_ITEM_TYPES
+    bandTypes = PRICING_BAND_TYPES
+
+    def emptyColumns():
+        return {name: [] for name in lineItemTypes}, {name: [] for name in bandTypes}
+
+    items, bands = emptyColumns()
+    itemFields = [(items[LINE_ITEM_PREFIX + field], field) for field in LINE_ITEM_COLUMNS]
+    bandFields = [(bands[PRICING_BAND_PREFIX + field], field) for field in PRICING_BAND_COLUMNS]
+    for bill in bills:
+        if billDate is not None and bill.get('billDate') != billDate:
+            continue
+        meta = [(items[field], bill.get(field)) for field in BILL_META_COLUMNS]
+        for lineItemIndex, lineItem in enumerate(bill.get('lineItems') or []):
+            if lineItem is None:
+                continue
+            items['lineItemIndex'].append(lineItemIndex)
+            for target, value in meta:
+                target.append(value)
+            for target, field in itemFields:
+                target.append(lineItem.get(field))
+            for band in lineItem.get('usagePerPricingBand') or []:
+                bands['id'].append(bill['id'])
+                bands['lineItemIndex'].append(lineItemIndex)
+                for target, field in bandFields:
+                    target.append(band.get(field))
+
+            if len(items['lineItemIndex']) >= chunkSize:
+                yield typedFrame(items, lineItemTypes), typedFrame(bands, bandTypes)
+                items, bands = emptyColumns()
+                itemFields = [(items[LINE_ITEM_PREFIX + field], field) for field in LINE_ITEM_COLUMNS]
+                bandFields = [(bands[PRICING_BAND_PREFIX + field], field) for field in PRICING_BAND_COLUMNS]
+                meta = [(items[field], bill.get(field)) for field in BILL_META_COLUMNS]
+
+    if items['lineItemIndex']:
+        yield typedFrame(items, lineItemTypes), typedFrame(bands, bandTypes)
+
+
+# Pricing band join - attaches band pricing to line items by bill id + lineItemIndex, never by row position.
+# how='aggregate' keeps one row per line item with the quantity-weighted unit price, band total and band count;
+# how='explode' gives one row per band, with the band's own quantity and unit price (line items without bands keep
+# a single row).
+def joinPricingBands(lineItems, bands, how='aggregate'):
+    keys = ['id', 'lineItemIndex']
+    unitPrice = PRICING_BAND_PREFIX + 'unitPrice'
+    bandQuantity = PRICING_BAND_PREFIX + 'bandQuantity'
+    bandSubtotal = PRICING_BAND_PREFIX + 'bandSubtotal'
+    if how == 'explode':
+        joined = lineItems.merge(bands, how='left', on=keys)
+        joined[LINE_ITEM_PREFIX + 'quantity'] = joined[bandQuantity].fillna(joined[LINE_ITEM_PREFIX + 'quantity'])
+        return joined
+    if how != 'aggregate':
+        raise ValueError(f'Unknown pricing band join: {how}')
+
+    weighted = bands[keys].copy()
+    weighted['quantity'] = bands[bandQuantity].fillna(0)
+    weighted['amount'] = bands[unitPrice] * weighted['quantity']
+    weighted['subtotal'] = bands[bandSubtotal]
+    weighted['firstPrice'] = bands[unitPrice]
+    grouped = weighted.groupby(keys, sort=False).agg(quantity=('quantity', 'sum'), amount=('amount', 'sum'),
+                                                      subtotal=('subtotal', 'sum'), firstPrice=('firstPrice', 'first'),
+                                                      bandCount=('firstPrice', 'size'))
+    perLineItem = pd.DataFrame({
+        unitPrice: (grouped['amount'] / grouped['quantity']).where(grouped['quantity'] > 0, grouped['firstPrice']),
+        PRICING_BAND_PREFIX + 'total': grouped['subtotal'],
+        PRICING_BAND_PREFIX + 'bandCount': grouped['bandCount'].astype('int32'),
+    }).reset_index()
+    joined = lineItems.merge(perLineItem, how='left', on=keys)
+    joined[PRICING_BAND_PREFIX + 'bandCount'] = joined[PRICING_BAND_PREFIX + 'bandCount'].fillna(0).astype('int32')
+    return joined
+
+
+# Enrichment - each dimension table is reduced to its key plus the projected columns and indexed once (first row
+# wins for a duplicated key, instead of the row fan-out a merge would give; the xref reads are ordered by key so that
+# row is stable). Duplicated keys are counted and logged. Line items are then enriched with one vectorised positional
+# lookup per step; a step may key off a column added by an earlier step.
+class Lookup:
+    def __init__(self, table, key, columns):
+        duplicated = table[key].duplicated(keep='first')
+        self.duplicates = int(duplicated.sum())
+        if self.duplicates:
+            logger.warning(f'{self.duplicates} duplicate {key} row(s) ignored, first row wins, e.g. '
+                           f'{table.loc[duplicated, key].drop_duplicates().head(5).tolist()}')
+            table = table[~duplicated]
+        self.key = key
+        self.columns = list(columns)
+        self.index = pd.Index(table[key].astype(object))
+        self.values = {column: table[column].array for column in self.columns}
+
+    def positions(self, keys):
+        return self.index.get_indexer(keys.astype(object))
+
+    def take(self, positions):
+        return {name: values.take(positions, allow_fill=True) for name, values in self.values.items()}
+
+
+class Enrichment:
+    # steps: (line item column, dimension table, dimension key, [columns to add])
+    def __init__(self, steps):
+        self.steps = [(column, Lookup(table, key, columns)) for column, table, key, columns in steps]
+
+    def duplicates(self):
+        return {lookup.key: lookup.duplicates for keyColumn, lookup in self.steps if lookup.duplicates}
+
+    def apply(self, lineItems):
+        enriched = lineItems.copy()
+        for keyColumn, lookup in self.steps:
+            for name, values in lookup.take(lookup.positions(enriched[keyColumn])).items():
+                enriched[name] = values
+        return enriched
+
+
+class BillStream:
+    # The bills of a page stream, so pages are flattened as they arrive and dropped instead of being collected into
+    # one list first. count is the number of bills seen; with a BillSyncState only new or recalculated bills pass,
+    # and those are kept in changed for state.record() once the export has succeeded. Bills from before the start of
+    # the sync are kept in seeded, to be recorded without being exported.
+    def __init__(self, pages, state=None):
+        self.pages = pages
+        self.state = state
+        self.count = 0
+        self.changed = []
+        self.seeded = []
+
+    def __iter__(self):
+        for page in self.pages:
+            self.count += len(page)
+            if self.state is not None:
+                page = self.state.changedBills(page, seeded=self.seeded)
+                self.changed.extend(page)
+            yield from page
+
+
+def prepareLineItems(bills, billDate, report):
+    # Flattened, priced line items for the export - billDate=None keeps every bill. bills is a list or a BillStream
+    with report.stage('flatten bills') as stage:
+        chunks = list(flattenBills(bills, billDate=billDate))
+        stage.rowsIn = bills.count if isinstance(bills, BillStream) else len(bills)
+        bills_df = pd.concat([chunk[0] for chunk in chunks], ignore_index=True) if chunks else \
+            emptyFrame(LINE_ITEM_TYPES)
+        pricingBand_df = pd.concat([chunk[1] for chunk in chunks], ignore_index=True) if chunks else \
+            emptyFrame(PRICING_BAND_TYPES)
+        del chunks
+        stage.rowsOut = len(bills_df)
+
+    with report.stage('join pricing bands', rowsIn=len(bills_df) + len(pricingBand_df)) as stage:
+        bills_df = joinPricingBands(bills_df, pricingBand_df, how=os.getenv('PRICING_BAND_JOIN', 'aggregate'))
+
+        bills_df_columns = bills_df.reindex(columns=[
+            'id', 'accountId', 'accountCode', 'lineItems-productId', 'lineItems-quantity', 'lineItems-productName',
+            'lastCalculatedDate', 'lineItems-description', 'lineItems-meterId',
+            'lineItems-usagePerPricingBand-unitPrice', 'lineItems-planId'])
+
+        # Reformat lastCalculatedDate and UnitPrice
+        bills_df_columns['lastCalculatedDate'] = bills_df_columns['lastCalculatedDate'].dt.strftime('%d/%m/20%y')
+        bills_df_columns = bills_df_columns.round(2)
+        stage.rowsOut = len(bills_df_columns)
+    return bills_df_columns
+
+
+def referenceFrames(sources, report):
+    with report.stage('reference frames', rowsIn=sum(len(sources[name]) for name in ['accounts', 'meters', 'plans'])) \
+            as stage:
+        frames = {'accounts': m3ter.Account.toFrame(sources['accounts']),
+                  'meters': m3ter.Meter.toFrame(sources['meters']),
+                  'plans': m3ter.Plan.toFrame(sources['plans'])}
+        stage.rowsOut = sum(len(frame) for frame in frames.values())
+    return frames
+
+
+def openXrefDatabase():
+    return m3ter.openSqlAlchemy(poolSize=2, maxOverflow=0)
+
+
+def xrefSnapshotReaders():
+    # Readers of the onfido aurora xref tables from the local snapshot when XREF_SNAPSHOT_PATH is set (the default),
+    # else {}. They do not depend on the bills, so they go into the first fetchSources call with the API fetches.
+    snapshotPath = os.getenv('XREF_SNAPSHOT_PATH', 'logs/xref')
+    if not snapshotPath:
+        return {}
+    snapshot = ReferenceSnapshot(snapshotPath, openXrefDatabase, os.environ['currentSchemaName'],
+                                 ttl=float(os.getenv('XREF_SNAPSHOT_TTL', '3600')),
+                                 changedColumn=os.getenv('XREF_CHANGED_COLUMN'))
+    return {
+        'input_activeproducts': lambda: snapshot.read('input_activeproducts', PRODUCT_COLUMNS),
+        'bill_netsuite_xref': lambda: snapshot.read('bill_netsuite_xref', BUNDLE_COLUMNS),
+    }
+
+
+def readXref(frames, meterIds, planIds, report, sources=None):
+    # read from onfido aurora database to find netsuite product ids and netsuite bundle id - taken from sources when
+    # they were already read from the snapshot (see xrefSnapshotReaders), otherwise read for just the meters and plans
+    # in meterIds / planIds
+    references = sources if sources is not None and 'input_activeproducts' in sources else None
+    if references is None:
+        currentSchema = os.environ['currentSchemaName']
+        connection = openXrefDatabase()
+        meter_df, plan_df = frames['meters'], frames['plans']
+        meterCodes = meter_df.loc[meter_df['meterId'].isin(meterIds), 'meterCode']
+        planCodes = plan_df.loc[plan_df['planId'].isin(planIds), 'planCode']
+        readers = {
+            'input_activeproducts': lambda: readReference(connection, currentSchema, 'input_activeproducts',
+                                                          PRODUCT_COLUMNS, 'Meter_Code__c', meterCodes.astype(object)),
+            'bill_netsuite_xref': lambda: readReference(connection, currentSchema, 'bill_netsuite_xref',
+                                                        BUNDLE_COLUMNS, 'opportunityId', planCodes.astype(object)),
+        }
+        references, timings = fetchSources(readers, report=report)
+    frames['products'] = references['input_activeproducts']
+    frames['bundles'] = references['bill_netsuite_xref']
+    return frames
+
+
+def exportLineItems(bills_df_columns, frames, report, base=None):
+    # enrich line items from all tables
+    with report.stage('enrich', rowsIn=len(bills_df_columns)) as stage:
+        enrichment = Enrichment([
+            ('accountId', frames['accounts'], 'accountId', ['subsidiaryId']),
+            ('lineItems-planId', frames['plans'], 'planId', ['planCode']),
+            ('lineItems-meterId', frames['meters'], 'meterId', ['meterCode']),
+            ('meterCode', frames['products'], 'Meter_Code__c', ['Netsuite_Product_Id__c']),
+            ('planCode', frames['bundles'], 'opportunityId', ['netsuiteId']),
+        ])
+        dataExfiltration = enrichment.apply(bills_df_columns)
+        if enrichment.duplicates():
+            report.meta['duplicateKeys'] = enrichment.duplicates()
+
+        # NC Addition ------------------------
+        dataExfiltration['Netsuite_Product_Id__c'] = dataExfiltration['Netsuite_Product_Id__c'].fillna("0")
+        dataExfiltration['Netsuite_Product_Id__c'] = dataExfiltration['Netsuite_Product_Id__c'].astype(int)
+        stage.rowsOut = len(dataExfiltration)
+
+    # wide debug dump of every enriched column, only when EXPORT_LINE_ITEMS=1
+    if os.getenv('EXPORT_LINE_ITEMS') == '1':
+        with report.stage('write lineItems', rowsIn=len(dataExfiltration)) as stage:
+            exportFrame(dataExfiltration, 'lineItems', base)
+            stage.rowsOut = len(dataExfiltration)
 
     dataExfiltration = dataExfiltration[
-        ['customFields.subsidiaryId', 'accountCode', 'Netsuite_Product_Id__c', 'netsuiteId', 'lineItems-quantity',
+        ['subsidiaryId', 'accountCode', 'Netsuite_Product_Id__c', 'netsuiteId', 'lineItems-quantity',
          'lineItems-usagePerPricingBand-unitPrice', 'lastCalculatedDate']]
 
     # data cleanup
-    dataExfiltration.columns = dataExfiltration.columns.str.replace('accountCode', 'SF Account ID')
-    dataExfiltration.columns = dataExfiltration.columns.str.replace('Netsuite_Product_Id__c', 'Netsuite Product Code')
-    dataExfiltration.columns = dataExfiltration.columns.str.replace('lineItems-quantity', 'Quantity')
-    dataExfiltration.columns = dataExfiltration.columns.str.replace('lineItems-usagePerPricingBand-unitPrice', 'Price')
-    dataExfiltration.columns = dataExfiltration.columns.str.replace('lastCalculatedDate', 'Date')
-    dataExfiltration.columns = dataExfiltration.columns.str.replace('customFields.subsidiaryId', 'Subsidiary ID')
-
-    dataExfiltration['Subsidiary ID'] = dataExfiltration['Subsidiary ID'].astype(int)
+    dataExfiltration = dataExfiltration.rename(columns={
+        'accountCode': 'SF Account ID', 'Netsuite_Product_Id__c': 'Netsuite Product Code',
+        'lineItems-quantity': 'Quantity', 'lineItems-usagePerPricingBand-unitPrice': 'Price',
+        'lastCalculatedDate': 'Date', 'subsidiaryId': 'Subsidiary ID'})
 
     # dropping null prices
     dataExfiltration.drop(dataExfiltration.loc[dataExfiltration['Price'] == 0].index, inplace=True)
     # drop rows with 0 in the netsuite product code - aka. bundles
     dataExfiltration = dataExfiltration[dataExfiltration['Netsuite Product Code'] != 0]
+    # quantities are flattened as float64; whole ones are written as integers (103, not 103.0) like the API sends them
+    quantity = dataExfiltration['Quantity']
+    if (quantity.dropna() % 1 == 0).all():
+        dataExfiltration = dataExfiltration.assign(Quantity=quantity.astype('Int64'))
+
+    with report.stage('write dataExfiltration', rowsIn=len(dataExfiltration)) as stage:
+        target = exportFrame(dataExfiltration, 'dataExfiltration', base)
+        stage.rowsOut = len(dataExfiltration)
+    return target, len(dataExfiltration)
 
-    df_to_s3(dataExfiltration, 'dataExfiltration.csv')
 
+def writeReport(report):
+    # RUN_REPORT_PATH='' skips writing the run report
+    reportPath = os.getenv('RUN_REPORT_PATH', 'logs/runReport.json')
+    if reportPath:
+        report.write(reportPath)
+
+
+def main(incremental=False, statePath=None, lookbackDays=None):
+    m3ter.printme('Starting execution ', time=True, color='red', dots=True)
+    state = BillSyncState(statePath or os.getenv('BILL_SYNC_STATE', 'logs/billSyncState.db')) if incremental else None
+    if lookbackDays is None:
+        lookbackDays = int(os.getenv('BILL_SYNC_LOOKBACK_DAYS', '35'))
+
+    # BilDate == yesterday, filtered server side so only yesterday's bills are downloaded
+    yday = (datetime.today() - timedelta(days=1)).date()
+    if state is not None:
+        state.begin(yday)
+    windowStart, windowEnd = billWindow(yday, state, lookbackDays)
+    report = RunReport('dataExfiltration', traceMemory=os.getenv('RUN_REPORT_TRACE_MEMORY') == '1',
+                       billDate=yday.isoformat(), windowStart=windowStart.isoformat(),
+                       windowEnd=windowEnd.isoformat(), incremental=incremental)
+
+    # Bill pages are flattened on the fetch thread as they arrive, so only the typed line item chunks are kept
+    start = time.perf_counter()
+    bills = BillStream(m3ter.Bill().loadForBillDate(windowStart, windowEnd, prefetch=True), state)
+    sources, timings = fetchSources(dict({
+        'bills': lambda: prepareLineItems(bills, None if state is not None else yday.isoformat(), report),
+        'accounts': lambda: m3ter.Account().load(),
+        'meters': lambda: m3ter.Meter().load(),
+        'plans': lambda: m3ter.Plan().load(),
+    }, **xrefSnapshotReaders()), report=report)
+    m3ter.printme(f'Fetch stage: {time.perf_counter() - start:.2f}s (sum of sources {sum(timings.values()):.2f}s)',
+                  color='cyan', dots=True)
+    m3ter.printme('#Bill(s): ' + str(bills.count), color='yellow', dots=True)
+    if state is not None:
+        m3ter.printme('#New or recalculated Bill(s): ' + str(len(bills.changed)), color='yellow', dots=True)
+
+    bills_df_columns = sources['bills']
+    frames = referenceFrames(sources, report)
+    frames = readXref(frames, bills_df_columns['lineItems-meterId'], bills_df_columns['lineItems-planId'], report,
+                      sources)
+    exportLineItems(bills_df_columns, frames, report)
+    if state is not None:
+        state.record(bills.seeded + bills.changed)
+
+    writeReport(report)
     m3ter.printme('Execution complete ', time=True, color='red', dots=True)
+    return report
+
+
+# Backfill - one run for a range of bill dates (e.g. the month-end catch-up). Bills for the whole range and the
+# reference data are fetched once, the bills are partitioned by billDate and every partition is exported on a
+# process pool to <export target>/<billDate>/. Days without bills still get an (empty) export. The reference frames
+# are the same for every day, so they are pickled once per worker by its initializer rather than once per day.
+workerFrames = None
+
+
+def initExportWorker(frames):
+    global workerFrames
+    workerFrames = frames
+
+
+def exportDay(billDate, bills, base, frames=None):
+    frames = workerFrames if frames is None else frames
+    report = RunReport('dataExfiltration', billDate=billDate)
+    start = time.perf_counter()
+    bills_df_columns = prepareLineItems(bills, billDate, report)
+    target, rows = exportLineItems(bills_df_columns, frames, report, base)
+    return {'billDate': billDate, 'bills': len(bills), 'rows': rows, 'target': target,
+            'seconds': round(time.perf_counter() - start, 4), 'stages': [stage.todict() for stage in report.stages]}
+
+
+def backfill(fromDate, toDate, maxWorkers=None):
+    m3ter.printme(f'Starting backfill {fromDate} - {toDate} ', time=True, color='red', dots=True)
+    if isinstance(fromDate, str):
+        fromDate = datetime.fromisoformat(fromDate).date()
+    if isinstance(toDate, str):
+        toDate = datetime.fromisoformat(toDate).date()
+    if toDate < fromDate:
+        raise ValueError(f'--to {toDate} is before --from {fromDate}')
+    report = RunReport('dataExfiltration', traceMemory=os.getenv('RUN_REPORT_TRACE_MEMORY') == '1',
+                       windowStart=fromDate.isoformat(), windowEnd=(toDate + timedelta(days=1)).isoformat(),
+                       backfill=True)
+
+    # Every day's bills are shipped whole to a worker process, so they are held until then - but they go straight
+    # from each page into their day's partition, and the meter / plan ids for the xref read are collected on the way
+    days = [(fromDate + timedelta(days=offset)).isoformat() for offset in range((toDate - fromDate).days + 1)]
+    partitions = {day: [] for day in days}
+    meterIds, planIds = set(), set()
+
+    def partitionBills():
+        count = 0
+        for page in m3ter.Bill().loadForBillDate(fromDate, toDate + timedelta(days=1), prefetch=True):
+            count += len(page)
+            for bill in page:
+                if bill.get('billDate') not in partitions:
+                    continue
+                partitions[bill['billDate']].append(bill)
+                for lineItem in bill.get('lineItems') or []:
+                    meterIds.add(lineItem.get('meterId'))
+                    planIds.add(lineItem.get('planId'))
+        return count
+
+    sources, timings = fetchSources(dict({
+        'bills': partitionBills,
+        'accounts': lambda: m3ter.Account().load(),
+        'meters': lambda: m3ter.Meter().load(),
+        'plans': lambda: m3ter.Plan().load(),
+    }, **xrefSnapshotReaders()), report=report)
+    m3ter.printme(f"#Bill(s): {sources['bills']} over {len(days)} day(s)", color='yellow', dots=True)
+
+    frames = referenceFrames(sources, report)
+    frames = readXref(frames, pd.Series(list(meterIds), dtype=object), pd.Series(list(planIds), dtype=object), report,
+                      sources)
+    del sources
+
+    base = exportTarget()
+    results = []
+    with ProcessPoolExecutor(max_workers=maxWorkers or min(len(days), os.cpu_count() or 1),
+                             initializer=initExportWorker, initargs=(frames,)) as pool:
+        futures = [pool.submit(exportDay, day, partitions.pop(day), base + '/' + day) for day in days]
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            report.addStages(result['stages'], prefix=result['billDate'] + ' ')
+            m3ter.printme(f"Exported {result['billDate']}: {result['bills']} bill(s), {result['rows']} row(s) in "
+                          f"{result['seconds']:.2f}s", color='cyan', dots=True)
+    report.meta['partitions'] = [{key: value for key, value in result.items() if key != 'stages'}
+                                 for result in results]
+
+    writeReport(report)
+    m3ter.printme('Backfill complete ', time=True, color='red', dots=True)
+    return report
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Onfido m3ter bill extract")
+    parser.add_argument('--incremental', action='store_true',
+                        help='only export bills that are new or recalculated since the last incremental run')
+    parser.add_argument('--state-path', help='sqlite file holding the incremental sync state')
+    parser.add_argument('--lookback-days', type=int, help='days before the high-water mark to re-scan for recalculations')
+    parser.add_argument('--from', dest='fromDate', type=lambda value: datetime.fromisoformat(value).date(),
+                        help='backfill: first bill date to export (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='toDate', type=lambda value: datetime.fromisoformat(value).date(),
+                        help='backfill: last bill date to export, inclusive (default yesterday)')
+    parser.add_argument('--workers', type=int, help='backfill: processes exporting days in parallel')
+    args = parser.parse_args()
+    if args.fromDate or args.toDate:
+        if args.incremental:
+            parser.error('--from/--to cannot be combined with --incremental')
+        if not args.fromDate:
+            parser.error('--to needs --from')
+        backfill(args.fromDate, args.toDate or (datetime.today() - timedelta(days=1)).date(), maxWorkers=args.workers)
+    else:
+        main(incremental=args.incremental, statePath=args.state_path, lookbackDays=args.lookback_days)
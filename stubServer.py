@@ -0,0 +1,222 @@
+# Local stand-in for the m3ter API, for offline benchmarks and manual runs without credentials
+# Serves synthetic, paginated /bills, /accounts, /meters and /plans plus /oauth/token; measurements POSTed to
+# /measurements are kept and served back, paginated, by GET /measurements (filterable by meter and account)
+# Usage: python stubServer.py --line-items 100000 --latency 0.02 --port 8080 --xref sqlite:///logs/xref.db
+# then:  M3TER_API_URL=http://127.0.0.1:8080 DATABASE_URL=sqlite:///logs/xref.db currentSchemaName=main python main.py
+
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import pandas as pd
+from sqlalchemy import create_engine
+
+BILL_DATES = ['2022-11-01', '2022-11-02']
+METERS = 11
+PLANS = 5
+
+
+def syntheticBills(lineItems, lineItemsPerBill=20, bandsPerLineItem=(0, 1, 1, 1, 2, 3), billDates=None, accounts=500,
+                   seed=1):
+    # Bills shaped like the /bills response, spread evenly across billDates
+    billDates = billDates or BILL_DATES
+    rng = random.Random(seed)
+    bills = []
+    for b in range(0, lineItems, lineItemsPerBill):
+        items = []
+        for i in range(min(lineItemsPerBill, lineItems - b)):
+            quantity = rng.randint(1, 1000)
+            bands = []
+            for n in range(rng.choice(bandsPerLineItem)):
+                bandQuantity = quantity if n == 0 else rng.randint(1, quantity)
+                unitPrice = round(rng.uniform(0.1, 2.0), 2)
+                bands.append({'lowerLimit': n * 1000.0, 'fixedPrice': 0.0, 'unitPrice': unitPrice,
+                              'bandQuantity': bandQuantity, 'bandSubtotal': bandQuantity * unitPrice,
+                              'bandUnits': bandQuantity, 'creditTypeId': ''})
+            items.append({'productId': f'product-{i % 7}', 'productName': f'Product {i % 7}',
+                          'description': f'Usage {i}', 'meterId': f'meter-{i % METERS}', 'planId': f'plan-{i % PLANS}',
+                          'lineItemType': 'USAGE', 'quantity': quantity, 'subtotal': quantity * 1.0,
+                          'usagePerPricingBand': bands})
+        billNumber = b // lineItemsPerBill
+        bills.append({'id': f'bill-{billNumber}', 'version': 1, 'accountId': f'account-{billNumber % accounts}',
+                      'accountCode': f'00100000{billNumber % accounts:07d}', 'startDate': '2022-10-01',
+                      'endDate': '2022-11-01', 'startDateTimeUTC': '2022-10-01T00:00:00Z',
+                      'endDateTimeUTC': '2022-11-01T00:00:00Z', 'billDate': billDates[billNumber % len(billDates)],
+                      'dueDate': '2022-11-15', 'billingFrequency': 'MONTHLY', 'billFrequencyInterval': 1,
+                      'timezone': 'UTC', 'currency': 'USD', 'locked': False, 'createdDate': '2022-11-01T01:00:00Z',
+                      'status': 'PENDING', 'billJobId': 'job-1', 'lastCalculatedDate': '2022-11-01T02:00:00Z',
+                      'lineItems': items})
+    return bills
+
+
+def syntheticDataset(lineItems, lineItemsPerBill=20, billDates=None, accounts=500, seed=1):
+    # The collections a bill export reads, with ids and codes that line up with syntheticBills and xrefFixture
+    billDates = billDates or [(date.today() - timedelta(days=1)).isoformat()]
+    return {
+        'bills': syntheticBills(lineItems, lineItemsPerBill, billDates=billDates, accounts=accounts, seed=seed),
+        'accounts': [{'id': f'account-{i}', 'code': f'00100000{i:07d}', 'name': f'Account {i}', 'version': 1,
+                      'customFields': {'subsidiaryId': str(i % 9) if i % 50 else None}} for i in range(accounts)],
+        'meters': [{'id': f'meter-{i}', 'code': f'MC{i}', 'name': f'Meter {i}', 'version': 1,
+                    'productId': f'product-{i % 7}'} for i in range(METERS)],
+        'plans': [{'id': f'plan-{i}', 'code': f'OPP{i}', 'name': f'Plan {i}', 'version': 1,
+                   'planTemplateId': 'template-1'} for i in range(PLANS)],
+    }
+
+
+def xrefFixture(url, schema=None):
+    # Writes input_activeproducts and bill_netsuite_xref for the synthetic meters and plans to any SQLAlchemy url
+    # (sqlite or Postgres). Every fourth meter has no NetSuite product and only some plans are bundles, so the
+    # export's fill and drop rules are exercised.
+    engine = create_engine(url)
+    pd.DataFrame({'Meter_Code__c': [f'MC{i}' for i in range(METERS)],
+                  'Netsuite_Product_Id__c': [str(100 + i) if i % 4 else None for i in range(METERS)],
+                  'IsActive': 1}).to_sql('input_activeproducts', engine, schema=schema, if_exists='replace', index=False)
+    pd.DataFrame({'opportunityId': [f'OPP{i}' for i in range(3)], 'netsuiteId': [f'NS{i}' for i in range(3)],
+                  'bundle': 'b'}).to_sql('bill_netsuite_xref', engine, schema=schema, if_exists='replace', index=False)
+    engine.dispose()
+    return url
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self, method):
+        stub = self.server.stub
+        parsed = urlparse(self.path)
+        segments = parsed.path.strip('/').split('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        stub.count(method, parsed.path, len(body))
+        if stub.latency:
+            time.sleep(stub.latency)
+        if stub.errorRate and stub.random.random() < stub.errorRate:
+            return self.reply(429, {'message': 'Too many requests'})
+
+        if segments[:2] == ['oauth', 'token']:
+            return self.reply(200, {'access_token': 'stub-token', 'token_type': 'Bearer', 'expires_in': 3600})
+        if len(segments) < 3 or segments[0] != 'organizations':
+            return self.reply(404, {'message': 'Not found: ' + parsed.path})
+        collection = segments[2]
+        if collection == 'measurements' and method == 'POST':
+            stub.received(json.loads(body or b'{}').get('measurements') or [])
+            return self.reply(200, {'result': 'accepted'})
+        if method != 'GET' or collection not in stub.data or len(segments) > 3:
+            return self.reply(404, {'message': 'Not found: ' + parsed.path})
+
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        objects = stub.data[collection]
+        if collection == 'bills' and ('billDateStart' in query or 'billDateEnd' in query):
+            objects = [bill for bill in objects if query.get('billDateStart', '') <= bill['billDate']
+                       < query.get('billDateEnd', '9999')]
+        if collection == 'measurements':
+            with stub._lock:
+                objects = list(objects)
+            for field in ('meter', 'account'):
+                if field in query:
+                    objects = [measurement for measurement in objects if measurement.get(field) == query[field]]
+        offset = int(query.get('nextToken') or 0)
+        pageSize = min(int(query.get('pageSize') or stub.pageSize), 5000)
+        page = {'data': objects[offset:offset + pageSize]}
+        if offset + pageSize < len(objects):
+            page['nextToken'] = str(offset + pageSize)
+        return self.reply(200, page)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+
+class StubServer:
+    # Threaded HTTP server on a background thread. latency seconds are added to every request and errorRate of the
+    # requests get a 429, so retry and back-off paths can be benchmarked too. port=0 picks a free port. Posted
+    # measurements are appended to data['measurements'] in arrival order, so they can be paged back.
+    def __init__(self, data, latency=0.0, errorRate=0.0, pageSize=100, host='127.0.0.1', port=0, seed=1):
+        self.data = dict(data, measurements=list(data.get('measurements') or []))
+        self.latency = latency
+        self.errorRate = errorRate
+        self.pageSize = pageSize
+        self.random = random.Random(seed)
+        self.requests = {}
+        self.bytesReceived = 0
+        self.measurements = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, method, path, size):
+        with self._lock:
+            key = method + ' ' + path
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.bytesReceived += size
+
+    def received(self, measurements):
+        with self._lock:
+            self.measurements += len(measurements)
+            self.data['measurements'].extend(measurements)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='stubServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local m3ter API stand-in serving synthetic data')
+    parser.add_argument('--line-items', type=int, default=10000, help='bill line items to generate')
+    parser.add_argument('--line-items-per-bill', type=int, default=20)
+    parser.add_argument('--accounts', type=int, default=500)
+    parser.add_argument('--bill-date', action='append', help='bill date(s) to spread the bills over, default yesterday')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 429')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--xref', help='SQLAlchemy url to write the xref table fixture to, e.g. sqlite:///xref.db')
+    args = parser.parse_args()
+
+    if args.xref:
+        xrefFixture(args.xref)
+    stub = StubServer(syntheticDataset(args.line_items, args.line_items_per_bill, args.bill_date, args.accounts),
+                      latency=args.latency, errorRate=args.error_rate, pageSize=args.page_size, host=args.host,
+                      port=args.port)
+    print(f'Serving synthetic m3ter API on {stub.url} (Ctrl+C to stop)')
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        stub.server.server_close()
@@ -0,0 +1,154 @@
+# Async client against the local m3ter stand-in (stubServer.py); needs aiohttp
+# Run from the repository root: python -m unittest discover tests
+
+import os
+import sys
+import time
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import m3terSDK as m3ter
+import m3terAsyncSDK as m3terAsync
+from stubServer import StubServer, syntheticDataset
+
+BILL_DATES = ['2022-11-01', '2022-11-02']
+
+
+@unittest.skipIf(m3terAsync.aiohttp is None, 'aiohttp is not installed')
+class AsyncClientTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.data = syntheticDataset(1000, lineItemsPerBill=20, billDates=BILL_DATES, accounts=120)
+        cls.stub = StubServer(cls.data, pageSize=25).start()
+        cls.saved = (m3ter.ORGANIZATION, m3ter.root_api_url, m3ter.ingest_api_url, m3ter.auth_url,
+                     m3ter.tokenProvider, m3ter.executor.policy, m3ter.cache)
+        m3ter.ORGANIZATION = 'stub'
+        m3ter.configureEndpoints(cls.stub.url)
+        m3ter.tokenProvider = m3ter.TokenProvider('stub', 'stub')
+        m3ter.executor.policy = m3ter.RetryPolicy(maxAttempts=5, baseDelay=0.01, maxDelay=0.05)
+        m3ter.setCache(None)
+        m3ter.tokenProvider.get()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.stop()
+        (m3ter.ORGANIZATION, m3ter.root_api_url, m3ter.ingest_api_url, m3ter.auth_url, m3ter.tokenProvider,
+         m3ter.executor.policy, cache) = cls.saved
+        m3ter.setCache(cache)
+
+    def setUp(self):
+        self.stub.errorRate = 0.0
+        m3terAsync.Account().invalidateIndex()
+
+    async def asyncTearDown(self):
+        await m3terAsync.transport.close()
+
+    async def testLoadPagesThroughCollection(self):
+        accounts = await m3terAsync.Account().load(silent=True)
+        self.assertEqual([account['id'] for account in accounts], [account['id'] for account in self.data['accounts']])
+        self.assertEqual(self.stub.requests['GET /organizations/stub/accounts'], 5)
+
+    async def testIterPagesYieldsEachPage(self):
+        pages = [page async for page in m3terAsync.Meter().iterPages(params={'pageSize': 4})]
+        self.assertEqual([len(page) for page in pages], [4, 4, 3])
+
+    async def testEmptyNextTokenEndsPaging(self):
+        meter = m3terAsync.Meter()
+
+        async def lastPage(nextToken=None, params=None):
+            return {'data': [{'id': 'meter-0'}], 'nextToken': ''}
+
+        meter.list = lastPage
+        self.assertEqual([page async for page in meter.iterPages()], [[{'id': 'meter-0'}]])
+
+    async def testLoadForBillDateFiltersServerSide(self):
+        bills = [bill async for page in m3terAsync.Bill().loadForBillDate('2022-11-02') for bill in page]
+        self.assertEqual(len(bills), 25)
+        self.assertTrue(all(bill['billDate'] == '2022-11-02' for bill in bills))
+
+    async def testLookupsAreAwaitedAndIndexed(self):
+        account = m3terAsync.Account()
+        self.assertEqual(await account.codeGet('001000000000007'), 'account-7')
+        self.assertEqual(await account.nameGet('Account 9'), 'account-9')
+        self.assertEqual((await account.idGet('account-3'))['code'], '001000000000003')
+        self.assertEqual(await account.codeGetMany(['001000000000001', 'missing']),
+                         {'001000000000001': 'account-1', 'missing': None})
+        requests = self.stub.requests['GET /organizations/stub/accounts']
+        await account.codeGet('001000000000008')
+        self.assertEqual(self.stub.requests['GET /organizations/stub/accounts'], requests)
+        await account.refreshIndex()
+        self.assertGreater(self.stub.requests['GET /organizations/stub/accounts'], requests)
+
+    async def testThrottledRequestsAreRetried(self):
+        self.stub.errorRate = 0.3
+        plans = await m3terAsync.Plan().load(silent=True)
+        self.assertEqual(len(plans), len(self.data['plans']))
+
+    async def testEndpointLimitsAreShared(self):
+        endpoint = m3ter.RequestExecutor.endpoint(m3ter.root_api_url + m3terAsync.Plan.class_url)
+        m3ter.executor.configure(endpoint, rate=20, burst=1, concurrency=1)
+        try:
+            start = time.perf_counter()
+            await asyncio.gather(*[m3terAsync.Plan().list() for _ in range(5)])
+            self.assertGreaterEqual(time.perf_counter() - start, 0.18)
+        finally:
+            del m3ter.executor.limits[endpoint]
+
+    async def testMeasurementsArePosted(self):
+        before = self.stub.measurements
+        measurements = [m3ter.MeasurementData('MC1', '001000000000001', '2022-11-01T00:00:00Z', measure={'quantity': n},
+                                              id=f'uid-{n}') for n in range(3)]
+        await m3terAsync.Measure().send(measurements)
+        self.assertEqual(self.stub.measurements - before, 3)
+
+    async def testIngestRunsOffTheEventLoop(self):
+        before = self.stub.measurements
+        measurements = [m3ter.MeasurementData('MC3', '001000000000003', '2022-11-01T00:00:00Z', measure={'quantity': n},
+                                              id=f'ingest-{n}') for n in range(10)]
+        results = await m3terAsync.Measure().ingest(measurements, batchSize=4, maxWorkers=2)
+        self.assertEqual([result.count for result in results], [4, 4, 2])
+        self.assertEqual(self.stub.measurements - before, 10)
+
+    async def testPostedMeasurementsArePagedBack(self):
+        measurements = [m3ter.MeasurementData('MC2', '001000000000002', '2022-11-01T00:00:00Z', measure={'quantity': n},
+                                              id=f'paged-{n}') for n in range(30)]
+        await m3terAsync.Measure().send(measurements)
+        pages = [page async for page in m3terAsync.Measure().iterPages(params={'meter': 'MC2', 'pageSize': 25})]
+        self.assertEqual([len(page) for page in pages], [25, 5])
+        self.assertEqual([measurement['uid'] for page in pages for measurement in page],
+                         [f'paged-{n}' for n in range(30)])
+
+
+@unittest.skipIf(m3terAsync.aiohttp is None, 'aiohttp is not installed')
+class AsyncTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.transport = m3terAsync.AsyncTransport(concurrency=2)
+
+    async def session(self):
+        return self.transport._ensure()
+
+    def testSessionOfClosedLoopIsReleased(self):
+        first = asyncio.run(self.session())
+        second = asyncio.run(self.session())
+        self.assertIsNot(first, second)
+        self.assertTrue(first.closed)
+        asyncio.run(self.transport.close())
+        self.assertTrue(second.closed)
+
+    def testSessionOfIdleLoopIsClosedOnIt(self):
+        loop = asyncio.new_event_loop()
+        try:
+            first = loop.run_until_complete(self.session())
+            second = asyncio.run(self.session())
+            self.assertTrue(first.closed)
+            self.assertIsNone(first.connector)
+            asyncio.run(self.transport.close())
+            self.assertTrue(second.closed)
+        finally:
+            loop.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
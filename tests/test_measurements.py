@@ -0,0 +1,85 @@
+# Measurement encoding and ingest batching, no server needed
+# Run from the repository root: python -m unittest discover tests
+
+import os
+import sys
+import json
+import math
+import unittest
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import m3terSDK as m3ter
+
+
+class MeasurementColumnsTest(unittest.TestCase):
+    def assertEncodedLikeIterated(self, columns, **options):
+        encoded = list(columns.encoded(**options))
+        self.assertEqual([json.loads(measurement) for measurement in encoded], list(columns))
+        return encoded
+
+    def testEncodedMatchesIterated(self):
+        columns = m3ter.MeasurementColumns(
+            meter=['api', 'a"pi', 'm\u00e9ter', 'api'], account=['AC1', 'AC2', None, 'AC1'], ts=['t1', 't2', 't3', 't4'],
+            ets=[None, 'e2', None, 'e4'], uid=['u1', None, 'u3', ''],
+            measure={'calls': [1.0, math.nan, 1e16, -0.5], 'bytes': [math.nan, 2.5, 0.1, 3]},
+            who={'user': ['u', None, 'w', 'u'], 'n': [1, None, True, 0]}, what={'empty': [None] * 4},
+            metadata={'nested': [{'a': 1}, None, [1, 'x'], 'plain']})
+        self.assertEncodedLikeIterated(columns)
+        self.assertEncodedLikeIterated(columns, sliceSize=3)
+
+    def testNonFiniteMeasuresAreNotSet(self):
+        columns = m3ter.MeasurementColumns(meter=['m'] * 3, account=['a'] * 3, ts=['t'] * 3,
+                                           measure={'x': [math.inf, -math.inf, 1.0], 'y': [math.nan, 2.0, math.inf]})
+        encoded = self.assertEncodedLikeIterated(columns)
+        self.assertNotIn(b'measure', encoded[0])
+        self.assertEqual(list(columns)[1]['measure'], {'y': 2.0})
+
+    def testNoneMeasuresAreNotSet(self):
+        columns = m3ter.MeasurementColumns(meter=['m', 'm'], account=['a', 'a'], ts=['t', 't'], measure={'x': [None, 2]})
+        self.assertEqual([measurement.get('measure') for measurement in columns], [None, {'x': 2.0}])
+        self.assertEncodedLikeIterated(columns)
+
+    def testAppendedAndFrameBuiltColumns(self):
+        columns = m3ter.MeasurementColumns()
+        columns.append({'meter': 'm', 'account': 'a', 'ts': 't', 'measure': {'q': 1}})
+        columns.append({'meter': 'm', 'account': 'a', 'ts': 't', 'who': {'user': 'x'}, 'uid': 'k'})
+        self.assertEncodedLikeIterated(columns)
+        frame = pd.DataFrame({'meter': ['m'] * 3, 'account': ['A1', None, 'A3'], 'quantity': [1, None, 'x'],
+                              'user': ['u', None, 'w'], 'ts': pd.date_range('2022-11-01', periods=3, freq='h')})
+        columns = m3ter.measurementsFromFrame(frame, {'meter': 'meter', 'account': 'account', 'ts': 'ts',
+                                                      'measure': {'quantity': 'quantity'}, 'who': {'user': 'user'}})
+        self.assertEncodedLikeIterated(columns)
+
+    def testEmptyColumns(self):
+        self.assertEqual(list(m3ter.MeasurementColumns().encoded()), [])
+
+
+class IngestBatchTest(unittest.TestCase):
+    def batches(self, measurements, batchSize=2):
+        return list(m3ter.IngestPipeline(batchSize=batchSize).batches(measurements))
+
+    def testBatchesWithUidsAreIdempotent(self):
+        measurements = [m3ter.MeasurementData('MC1', 'AC1', '2022-11-01T00:00:00Z', id=f'uid-{n}') for n in range(3)]
+        self.assertEqual([idempotent for batch, idempotent in self.batches(measurements)], [True, True])
+
+    def testNestedUidFieldIsNotAMeasurementUid(self):
+        measurement = {'meter': 'MC1', 'account': 'AC1', 'ts': '2022-11-01T00:00:00Z', 'who': {'uid': 'u1'}}
+        self.assertFalse(self.batches([measurement])[0][1])
+        columns = m3ter.MeasurementColumns(meter=['MC1', 'MC1'], account=['AC1', 'AC1'], ts=['t', 't'],
+                                           who={'uid': ['u1', 'u2']})
+        self.assertEqual([idempotent for batch, idempotent in self.batches(columns)], [False])
+
+    def testColumnarUidsDecidePerBatch(self):
+        columns = m3ter.MeasurementColumns(meter=['MC1'] * 4, account=['AC1'] * 4, ts=['t'] * 4,
+                                           uid=['u1', 'u2', 'u3', None])
+        self.assertEqual([idempotent for batch, idempotent in self.batches([columns])], [True, False])
+
+    def testEncodedMeasurementsAreNotTakenToHaveAUid(self):
+        self.assertFalse(m3ter.hasUid(b'{"meter":"a","account":"b","ts":"t","who":{"uid":"u1"}}'))
+        self.assertFalse(m3ter.hasUid(b'{"meter":"a","account":"b","ts":"t","uid":"u1"}'))
+
+
+if __name__ == '__main__':
+    unittest.main()